@@ -0,0 +1,243 @@
+'''
+it is a file that contains the benchmark of the pipeline over data/test_articles, without a mongo server.
+Notes:
+1. the collections are kept in memory by storage.MemoryDatabase, so the numbers measure the pipeline itself and not the network.
+2. the corpus is scaled by replicating the article folders with symbolic links, the copy k of an article is titled "<title>_<k>". The xlsx demands are linked as they are, so the demands are not scaled.
+3. the stages are ingest, segment, sentiment and index (calculate_all). The topic stage needs a trained model and is not benchmarked.
+4. the memory of a stage is the maximum resident set size of the process (ru_maxrss), which never decreases, so it is the peak of the run up to the end of the stage. With --trace-memory the peak of the python allocations of each stage is also measured by tracemalloc, which slows down the stages allocating many small objects (segment), so the throughput of such a run should not be compared with a run without it.
+5. jieba loads its dictionary before the first stage, the loading is not counted in the segment stage.
+6. the medical words are read from the small sample in data/medical_words by default, so the benchmark runs on a clean checkout. Pass --medical-words chinese_medical_words to count the full list.
+7. run it from the root of the repository, e.g. python benchmark.py --scales 1,10 --save-baseline, then python benchmark.py --scales 1,10 to compare with the baseline.
+'''
+
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import global_var
+import instrumentation
+from storage import MemoryDatabase
+
+STAGES = ["ingest", "segment", "sentiment", "index"]
+
+
+def replicate_corpus(source_folder: str, target_folder: str, scale: int) -> None:
+    """
+    Builds a corpus scale times as large as the source with symbolic links to the source files.
+
+    Args:
+        source_folder (str): The folder of the author folders, like data/test_articles.
+        target_folder (str): The folder of the replicated corpus, it must be empty.
+        scale (int): The number of copies of every article.
+    """
+    for author in os.listdir(source_folder):
+        author_folder = os.path.join(source_folder, author)
+        if not os.path.isdir(author_folder):
+            continue
+        target_author_folder = os.path.join(target_folder, author)
+        os.makedirs(target_author_folder, exist_ok=True)
+        for file_name in os.listdir(author_folder):
+            source_path = os.path.abspath(os.path.join(author_folder, file_name))
+            if not file_name.endswith(".txt"):
+                os.symlink(source_path, os.path.join(target_author_folder, file_name))
+                continue
+            stem = file_name[: -len(".txt")]
+            for copy_index in range(scale):
+                copy_name = stem if copy_index == 0 else f"{stem}_{copy_index}"
+                os.symlink(
+                    source_path, os.path.join(target_author_folder, f"{copy_name}.txt")
+                )
+
+
+def run_stage(name: str, function, document_count, trace_memory: bool = False) -> dict:
+    """
+    Runs a stage and measures its time, throughput and memory.
+
+    Args:
+        name (str): The name of the stage.
+        function (callable): Called without arguments to run the stage.
+        document_count (callable): Returns the number of documents processed by the stage.
+        trace_memory (bool, optional): Measure the peak of the python allocations with tracemalloc.
+
+    Returns:
+        dict: The elapsed seconds, documents, documents per second, python peak memory
+            (None without trace_memory), maximum resident set size and the time of each
+            instrumentation kind.
+    """
+    instrumentation.collect()
+    if trace_memory:
+        tracemalloc.start()
+    start_time = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start_time
+    python_peak = None
+    if trace_memory:
+        python_peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    documents = document_count()
+    result = {
+        "elapsed": elapsed,
+        "documents": documents,
+        "docs_per_sec": documents / max(elapsed, 1e-9),
+        "python_peak_mb": python_peak,
+        # ru_maxrss is in kilobytes on linux
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10,
+        "children_max_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 2**10,
+        "kinds": instrumentation.summary()["kinds"],
+    }
+    print(
+        f"{name}: {documents} documents in {elapsed:.2f}s ({result['docs_per_sec']:.1f} docs/sec), "
+        f"max rss {result['max_rss_mb']:.1f}MB"
+        + (f", python peak {python_peak:.1f}MB" if trace_memory else "")
+    )
+    return result
+
+
+def benchmark(
+    source_folder: str, scale: int, workers: int = 1, trace_memory: bool = False
+) -> dict:
+    """
+    Runs the stages of the pipeline over a corpus replicated scale times.
+
+    Args:
+        source_folder (str): The folder of the articles, like data/test_articles.
+        scale (int): The number of copies of every article.
+        workers (int, optional): The number of worker processes of calculate_all.
+        trace_memory (bool, optional): Measure the python peak memory of every stage.
+
+    Returns:
+        dict: The result of run_stage for every stage.
+    """
+    import jieba
+    import calculate_index
+    import sentiment
+    from read_data import write_txt_html_xlsx2db
+
+    jieba.initialize()
+
+    database = MemoryDatabase(f"benchmark_{scale}x")
+    articles = database["articles"]
+    indexs = database["indexs"]
+    corpus_folder = tempfile.mkdtemp(prefix=f"benchmark_{scale}x_")
+    try:
+        replicate_corpus(source_folder, corpus_folder, scale)
+        stages = {
+            "ingest": lambda: write_txt_html_xlsx2db(
+                database, "articles", "articles", "demands", corpus_folder
+            ),
+            "segment": lambda: calculate_index.segment(articles),
+            "sentiment": lambda: sentiment.get_sentiment_list(
+                global_var.get_sentiment_dict(), articles, articles
+            ),
+            "index": lambda: calculate_index.calculate_all(
+                articles, indexs, workers=workers
+            ),
+        }
+        counts = {
+            "ingest": lambda: articles.estimated_document_count()
+            + database["demands"].estimated_document_count(),
+            "segment": lambda: articles.count_documents({"token_ids": {"$exists": True}}),
+            "sentiment": lambda: articles.count_documents(
+                {"sentiment_list": {"$exists": True}}
+            ),
+            "index": lambda: indexs.estimated_document_count(),
+        }
+        return {
+            stage: run_stage(
+                f"{scale}x {stage}", stages[stage], counts[stage], trace_memory
+            )
+            for stage in STAGES
+        }
+    finally:
+        shutil.rmtree(corpus_folder)
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Compares the throughput of every scale and stage with the baseline.
+
+    Args:
+        results (dict): The results of this run, scale -> stage -> result.
+        baseline (dict): The results of the baseline run.
+        tolerance (float): The accepted relative slowdown, e.g. 0.1 for 10%.
+
+    Returns:
+        list: The scales and stages slower than the baseline by more than the tolerance.
+    """
+    regressions = []
+    for scale, stages in results.items():
+        for stage, result in stages.items():
+            base = baseline.get(scale, {}).get(stage)
+            if base is None:
+                continue
+            ratio = result["docs_per_sec"] / max(base["docs_per_sec"], 1e-9)
+            memory_ratio = result["max_rss_mb"] / max(base["max_rss_mb"], 1e-9)
+            print(
+                f"{scale}x {stage}: {ratio:.2f}x throughput, "
+                f"{memory_ratio:.2f}x max rss of the baseline"
+            )
+            if ratio < 1 - tolerance:
+                regressions.append(f"{scale}x {stage}")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--folder", default="data/test_articles")
+    parser.add_argument("--scales", default="1", help="e.g. 1,10,100,1000")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--baseline", default="data/benchmark_baseline.json")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    parser.add_argument(
+        "--trace-memory", action="store_true", help="measure the python peak memory of every stage"
+    )
+    parser.add_argument("--output", default=None, help="write the results to this JSON file")
+    parser.add_argument(
+        "--medical-words", default="data/medical_words", help="the folder of the medical word lists"
+    )
+    parser.add_argument(
+        "--check-html", action="store_true", help="also check the HTML counting parity"
+    )
+    args = parser.parse_args()
+    global_var.medical_words_folder = args.medical_words
+
+    if args.check_html:
+        from calculate_index import check_html_parity
+
+        mismatches = check_html_parity(args.folder)
+        if mismatches:
+            print(f"{len(mismatches)} files are counted differently: {mismatches[:5]}")
+            return 1
+    results = {
+        str(scale): benchmark(args.folder, scale, args.workers, args.trace_memory)
+        for scale in map(int, args.scales.split(","))
+    }
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=4)
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(results, file, indent=4)
+        print(f"baseline saved to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"no baseline in {args.baseline}, run with --save-baseline first")
+        return 0
+    with open(args.baseline, "r") as file:
+        baseline = json.load(file)
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print(f"slower than the baseline: {regressions}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,18 +1,33 @@
+import collections
+import hashlib
 import math
+import multiprocessing
+import os
 import re
 import traceback
 import numpy as np
 import pymongo
 from tqdm import tqdm
 import global_var
-import jieba
+import instrumentation
 import jieba.posseg as pseg
 from bs4 import BeautifulSoup
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from html.parser import HTMLParser
 from global_var import SENTENCE_SPLIT, LONG2SHORT
+from pymongo import UpdateOne
 from pymongo.collection import Collection as PymongoCollection
-from collections import Counter
+from process_mongo import BulkWriter, batched, pack_array, unpack_array
+from segmentation import tokenize_text
+from vocabulary import POS, WORD, get_vocabulary_collection, load_vocabularies
 
+# Increase it when a metric changes, so the incremental mode calculates every article again
+METRICS_VERSION = 2
+# Increase it when the fields written by segment change, so the incremental mode segments every article again
+SEGMENT_VERSION = 2
+# The categories of the word dictionary counted by count_lexicon
+LEXICON_WORD_CATEGORIES = ["assertion", "cite", "level", "concession", "turning", "metaphor"]
 
 
 def calculate_entropy(probabilities: dict) -> float:
@@ -44,12 +59,30 @@ def sum_occurrences(a: list, b: list) -> int:
     return sum(counter_b[element] for element in a)
 
 
-def count_html_elements(html_content: str) -> dict:
+class _TagCounter(HTMLParser):
+    """
+    Counts the start tags of a HTML document in one pass without building a tree.
+    """
+
+    def __init__(self, tags: set) -> None:
+        super().__init__(convert_charrefs=True)
+        self.tags = tags
+        self.counts = Counter()
+
+    def handle_starttag(self, tag: str, attrs: list) -> None:
+        # <img/> goes through handle_startendtag, which calls this method too
+        if tag in self.tags:
+            self.counts[tag] += 1
+
+
+def count_html_elements(html_content: str, html_elements: dict = None) -> dict:
     """
     Counts the number of different HTML elements in the given HTML content.
 
     Args:
         html_content (str): The HTML content to be analyzed.
+        html_elements (dict, optional): A dictionary mapping each result key to the tags it counts.
+            Defaults to global_var.HTML_ELEMENTS.
 
     Returns:
         dict: A dictionary containing the counts of various HTML elements.
@@ -60,23 +93,63 @@ def count_html_elements(html_content: str) -> dict:
         >>> count_html_elements(html_content)
         {'images': 0, 'audio': 0, 'video': 0, 'paragraphs': 1, 'tables': 0, 'links': 0}
     """
+    if html_elements is None:
+        html_elements = global_var.HTML_ELEMENTS
+    parser = _TagCounter({tag for tags in html_elements.values() for tag in tags})
+    parser.feed(html_content)
+    parser.close()
+    return {
+        key: sum(parser.counts[tag] for tag in tags)
+        for key, tags in html_elements.items()
+    }
+
+
+def count_html_elements_soup(html_content: str, html_elements: dict = None) -> dict:
+    """
+    Counts the HTML elements with a BeautifulSoup tree, the reference of count_html_elements.
+
+    Args:
+        html_content (str): The HTML content to be analyzed.
+        html_elements (dict, optional): A dictionary mapping each result key to the tags it counts.
+            Defaults to global_var.HTML_ELEMENTS.
+
+    Returns:
+        dict: The same result as count_html_elements.
+    """
+    if html_elements is None:
+        html_elements = global_var.HTML_ELEMENTS
     soup = BeautifulSoup(html_content, "html.parser")
-    img_count = len(soup.find_all("img"))
-    audio_count = len(soup.find_all("audio"))
-    video_count = len(soup.find_all("video"))
-    p_count = len(soup.find_all("p"))
-    table_count = len(soup.find_all("table"))
-    link_count = len(soup.find_all("a"))
     return {
-        "images": img_count,
-        "audio": audio_count,
-        "video": video_count,
-        "paragraphs": p_count,
-        "tables": table_count,
-        "links": link_count,
+        key: sum(len(soup.find_all(tag)) for tag in tags)
+        for key, tags in html_elements.items()
     }
 
 
+def check_html_parity(parent_folder: str) -> list:
+    """
+    Compares count_html_elements with count_html_elements_soup on the html files of a folder.
+
+    Args:
+        parent_folder (str): The folder containing the author folders, like data/test_articles.
+
+    Returns:
+        list: The paths of the files whose counts differ, empty when both agree.
+    """
+    mismatches = []
+    for folder_name in os.listdir(parent_folder):
+        folder_path = os.path.join(parent_folder, folder_name)
+        for file_name in os.listdir(folder_path):
+            if file_name.startswith("html") and file_name.endswith(".txt"):
+                file_path = os.path.join(folder_path, file_name)
+                with open(file_path, "r", encoding="utf-8") as file:
+                    html_content = file.read()
+                if count_html_elements(html_content) != count_html_elements_soup(
+                    html_content
+                ):
+                    mismatches.append(file_path)
+    return mismatches
+
+
 def count_about_word(words: list[str]) -> dict:
     """
     Counts various metrics related to a list of words.
@@ -125,6 +198,36 @@ def count_about_word(words: list[str]) -> dict:
     }
 
 
+def count_about_word_ids(token_ids: np.ndarray, token_lengths: np.ndarray) -> dict:
+    """
+    Counts the metrics of count_about_word on the token ids stored by the segment stage.
+
+    Args:
+        token_ids (np.ndarray): The token ids of the article ('token_ids').
+        token_lengths (np.ndarray): The number of characters of each token id,
+            see vocabulary.Vocabulary.token_lengths.
+
+    Returns:
+        dict: The same metrics as count_about_word.
+    """
+    # The vocabulary is much larger than an article, so the ids are counted by np.unique
+    # instead of a bincount over the whole vocabulary
+    _, word_counts = np.unique(token_ids, return_counts=True)
+    total_word_count = len(token_ids)
+    unique_word_count = int((word_counts == 1).sum())
+    non_repeating_word_count = len(word_counts)
+    probabilities = word_counts / total_word_count
+    return {
+        "total_word_count": total_word_count,
+        "unique_word_count": unique_word_count,
+        "unique_word_percentage": unique_word_count / total_word_count,
+        "non_repeating_word_count": non_repeating_word_count,
+        "word_ratio": non_repeating_word_count / total_word_count,
+        "average_word_length": int(token_lengths[token_ids].sum()) / total_word_count,
+        "entropy": float(-(probabilities * np.log2(probabilities)).sum()),
+    }
+
+
 def count_word_pos(text: str):
     """
     Count the occurrences of each part-of-speech tag in the given text.
@@ -137,15 +240,44 @@ def count_word_pos(text: str):
             - 'pos_count': A dictionary mapping each part-of-speech tag to its count.
             - 'pos_list': A list of all part-of-speech tags in the order they appear in the text.
     """
-    words = pseg.cut(text)
+    return count_pos_tags([flag for word, flag in pseg.cut(text)])
+
+
+def count_pos_tags(pos_list: list) -> dict:
+    """
+    Count the occurrences of each part-of-speech tag in an already tagged text.
+
+    Args:
+        pos_list (list): The part-of-speech tags stored by the segment stage.
+
+    Returns:
+        dict: The same result as count_word_pos, without tagging the text again.
+    """
     pos_counts = {}
-    pos_list = []
-    for word, flag in words:
-        pos_list.append(flag)
+    for flag in pos_list:
         if flag not in pos_counts:
             pos_counts[flag] = 0
         pos_counts[flag] += 1
-    return {"pos_count": pos_counts, "pos_list": pos_list}
+    return {"pos_count": pos_counts, "pos_list": list(pos_list)}
+
+
+def count_pos_ids(pos_ids: np.ndarray, pos_tags: list) -> dict:
+    """
+    Count the occurrences of each part-of-speech tag from the tag ids stored by the segment stage.
+
+    Args:
+        pos_ids (np.ndarray): The tag ids of the article ('pos_ids').
+        pos_tags (list): The tag of each id, see vocabulary.Vocabulary.tokens.
+
+    Returns:
+        dict: A dictionary containing 'pos_count', mapping each tag to its count.
+    """
+    tag_counts = np.bincount(pos_ids, minlength=len(pos_tags))
+    return {
+        "pos_count": {
+            pos_tags[tag_id]: int(tag_counts[tag_id]) for tag_id in np.flatnonzero(tag_counts)
+        }
+    }
 
 
 def count_about_sentence(text: str, pos_list: list) -> dict:
@@ -168,6 +300,20 @@ def count_about_sentence(text: str, pos_list: list) -> dict:
             - break (float): The ratio of "x" marks per sentence.
             - v_a (float): The ratio of "v" marks to the sum of "v" and "a" marks.
     """
+    return count_about_sentence_pos_count(text, Counter(pos_list))
+
+
+def count_about_sentence_pos_count(text: str, pos_count: dict) -> dict:
+    """
+    Counts the metrics of count_about_sentence from the count of each part-of-speech tag.
+
+    Args:
+        text (str): The input text.
+        pos_count (dict): A dictionary mapping each part-of-speech tag to its count.
+
+    Returns:
+        dict: The same metrics as count_about_sentence.
+    """
     # Split the text into sentences
     sentences = re.split(SENTENCE_SPLIT, text)
     # Calculate the length of each sentence
@@ -189,11 +335,11 @@ def count_about_sentence(text: str, pos_list: list) -> dict:
     # Calculate a measure of sentence cohesion
     cohesive = 1 / average_length
     # Count the number of "x" marks in the part-of-speech list
-    mark_count = pos_list.count("x")
+    mark_count = pos_count.get("x", 0)
     # Count the number of "v" marks in the part-of-speech list
-    v = pos_list.count("v")
+    v = pos_count.get("v", 0)
     # Count the number of "a" marks in the part-of-speech list
-    a = pos_list.count("a")
+    a = pos_count.get("a", 0)
     return {
         "sentenced_length_dev": sentence_length_dev,
         "long_sentence_count": long_sentence_count,
@@ -201,7 +347,7 @@ def count_about_sentence(text: str, pos_list: list) -> dict:
         "sentence_count": sentence_count,
         "average_sentence_length": average_length,
         "cohesive": cohesive,
-        "mark_radio": mark_count / len(pos_list),
+        "mark_radio": mark_count / sum(pos_count.values()),
         "break": mark_count / sentence_count,
         "v_a": v / (v + a + 0.0001),
     }
@@ -287,6 +433,138 @@ def count_rare(text: str, rare_word: list) -> dict:
     return {"rare": total_count, "rare_percentage": total_count / len(text)}
 
 
+def build_lexicon(word_dict: dict, medical_list: list, rare_word: list) -> dict:
+    """
+    Compiles the word lists used by the counting indexs into one lookup table.
+
+    Each word is mapped to the categories it belongs to, weighted by the number of times
+    it is listed, so count_lexicon gives the same counts as
+    count_about_structure, count_metaphor, count_medical and count_rare.
+
+    Args:
+        word_dict (dict): The word dictionary, see global_var.get_word_dict.
+        medical_list (list): The list of medical terms.
+        rare_word (list): The list of rare characters.
+
+    Returns:
+        dict: A dictionary containing the following keys:
+            - categories: The names of the word categories.
+            - words: A dictionary mapping each word to a tuple of (category, weight).
+            - chars: The set of rare characters, each one is counted once like in count_rare.
+    """
+    categories = {
+        category: word_dict[category] for category in LEXICON_WORD_CATEGORIES
+    }
+    categories["medical"] = medical_list
+    words = {}
+    for category, category_words in categories.items():
+        for word, weight in Counter(category_words).items():
+            words.setdefault(word, []).append((category, weight))
+    return {
+        "categories": list(categories),
+        "words": {word: tuple(weights) for word, weights in words.items()},
+        "chars": frozenset(rare_word),
+    }
+
+
+def count_lexicon(word_list: list, text: str, lexicon: dict) -> dict:
+    """
+    Counts every word category and the rare characters of an article in one pass.
+
+    Args:
+        word_list (list): The segmented words of the article.
+        text (str): The text of the article.
+        lexicon (dict): The lookup table returned by build_lexicon.
+
+    Returns:
+        dict: A dictionary containing the count of each word category, the count of
+            rare characters ('rare') and their percentage in the text ('rare_percentage').
+    """
+    counts = dict.fromkeys(lexicon["categories"], 0)
+    words = lexicon["words"]
+    for word, word_count in Counter(word_list).items():
+        for category, weight in words.get(word, ()):
+            counts[category] += word_count * weight
+    chars = lexicon["chars"]
+    rare_count = sum(
+        char_count
+        for char, char_count in Counter(text).items()
+        if char in chars
+    )
+    counts["rare"] = rare_count
+    counts["rare_percentage"] = rare_count / len(text)
+    return counts
+
+
+def compile_id_lexicon(lexicon: dict, words) -> dict:
+    """
+    Maps the words of a lexicon to the ids of a vocabulary, for count_lexicon_ids.
+
+    The words missing from the vocabulary are dropped, no segmented article contains them.
+
+    Args:
+        lexicon (dict): The lookup table returned by build_lexicon.
+        words (vocabulary.Vocabulary): The word vocabulary.
+
+    Returns:
+        dict: A dictionary containing the following keys:
+            - categories: The names of the word categories.
+            - ids: The sorted token ids of the lexicon words.
+            - weights: An int array of shape (len(ids), len(categories)), the weight of each word in each category.
+            - chars: The set of rare characters.
+    """
+    columns = {category: column for column, category in enumerate(lexicon["categories"])}
+    rows = {}
+    for word, weights in lexicon["words"].items():
+        token_id = words.ids.get(word)
+        if token_id is None:
+            continue
+        row = np.zeros(len(columns), dtype=np.int64)
+        for category, weight in weights:
+            row[columns[category]] += weight
+        rows[token_id] = row
+    ids = np.array(sorted(rows), dtype=np.uint32)
+    return {
+        "categories": lexicon["categories"],
+        "ids": ids,
+        "weights": np.array(
+            [rows[token_id] for token_id in ids], dtype=np.int64
+        ).reshape(len(ids), len(columns)),
+        "chars": lexicon["chars"],
+    }
+
+
+def count_lexicon_ids(token_ids: np.ndarray, text: str, id_lexicon: dict) -> dict:
+    """
+    Counts the same categories as count_lexicon on the token ids stored by the segment stage.
+
+    Args:
+        token_ids (np.ndarray): The token ids of the article ('token_ids').
+        text (str): The text of the article, the rare characters are counted on it.
+        id_lexicon (dict): The lexicon returned by compile_id_lexicon.
+
+    Returns:
+        dict: The same counts as count_lexicon.
+    """
+    unique_ids, id_counts = np.unique(token_ids, return_counts=True)
+    # The row of each unique id in the lexicon, the ids which are not lexicon words are dropped
+    lexicon_ids = id_lexicon["ids"]
+    rows = np.searchsorted(lexicon_ids, unique_ids)
+    found = rows < len(lexicon_ids)
+    found[found] = lexicon_ids[rows[found]] == unique_ids[found]
+    category_counts = id_counts[found] @ id_lexicon["weights"][rows[found]]
+    counts = dict(zip(id_lexicon["categories"], category_counts.tolist()))
+    chars = id_lexicon["chars"]
+    rare_count = sum(
+        char_count
+        for char, char_count in Counter(text).items()
+        if char in chars
+    )
+    counts["rare"] = rare_count
+    counts["rare_percentage"] = rare_count / len(text)
+    return counts
+
+
 def count_is_real(pos_count: dict, is_real: dict) -> dict:
     """
     Calculate the percentage of real articles based on the positive count and is_real dictionary.
@@ -322,9 +600,31 @@ def count_parallelism(word_list: list, conjunctions_list: list) -> dict:
         dict: A dictionary containing the count of parallelism occurrences.
             The count is stored under the key "parallelism".
     """
+    filtered_lst = [item for item in word_list if item in conjunctions_list]
+    return {"parallelism": _count_repeated_close(filtered_lst)}
+
+
+def count_parallelism_ids(token_ids: np.ndarray, conjunction_ids: np.ndarray) -> dict:
+    """
+    Counts the parallelism occurrences like count_parallelism, on the token ids stored by the segment stage.
+
+    Args:
+        token_ids (np.ndarray): The token ids of the article ('token_ids').
+        conjunction_ids (np.ndarray): The token ids of the conjunctions.
+
+    Returns:
+        dict: A dictionary containing the count of parallelism occurrences under the key "parallelism".
+    """
+    filtered = token_ids[np.isin(token_ids, conjunction_ids)]
+    return {"parallelism": _count_repeated_close(filtered.tolist())}
+
+
+def _count_repeated_close(filtered_lst: list) -> int:
+    """
+    Counts the values of a list having three pairs of occurrences closer than 5 positions.
+    """
     from collections import defaultdict
 
-    filtered_lst = [item for item in word_list if item in conjunctions_list]
     positions = defaultdict(list)
     for idx, value in enumerate(filtered_lst):
         positions[value].append(idx)
@@ -342,7 +642,7 @@ def count_parallelism(word_list: list, conjunctions_list: list) -> dict:
                 if count >= 3:
                     break
 
-    return {"parallelism": len(result)}
+    return len(result)
 
 
 def count_metaphor(word_list: list, metaphorical_expressions: list) -> dict:
@@ -375,95 +675,431 @@ def count_fog(avg_sentence_len, complex_words_percentage) -> dict:
     return {"fog": 0.8 * avg_sentence_len + complex_words_percentage}
 
 
-def segment(collection_read: PymongoCollection) -> None:
+def content_hash(text: str, html: str) -> str:
+    """
+    Calculates the hash of the content of an article, used to find the articles whose text changed.
+
+    Args:
+        text (str): The text of the article.
+        html (str): The html of the article.
+
+    Returns:
+        str: The hex sha1 digest of the text and the html.
+    """
+    digest = hashlib.sha1(str(text).encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(str(html).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def segment(collection_read: PymongoCollection, incremental: bool = False) -> None:
     """
     Segments the text in each record of the 'articles' collection in the database.
-    Uses the jieba library to perform word segmentation on the 'text' field of each record.
-    Updates each record with a new field 'text_seg' containing the segmented text.
-    """
-    records = list(collection_read.find())
-    for record in tqdm(records, desc="Processing records segment", total=len(records)):
-        if "text" in record.keys():
-            # Perform word segmentation on the 'text' field using jieba library
-            text_seg = jieba.lcut(record["text"])
-            # Create a new record with the segmented text
-            record = {"title": record["title"], "text_seg": text_seg}
-            # Update the record in the collection
-            collection_read.update_one(
-                {"title": record["title"]}, {"$set": record}, upsert=True
-            )
-        else:
-            tqdm.write(f"text field is not found in the title{record}")
+    Uses segmentation.tokenize_text to cut the 'text' field of each record once.
+    Updates each record with the packed arrays 'token_ids', 'pos_ids' and 'sentence_ends'
+    (see vocabulary.py), which are read by the sentiment stage and calculate_all instead of
+    cutting the text again, and with the 'content_hash' of the text and html.
+    'pos_ids' is not aligned with 'token_ids', see segmentation.tokenize_text.
+    The lists of strings 'text_seg' and 'pos_seg' written by the previous versions are removed.
+
+    Args:
+        collection_read (PymongoCollection): The collection containing the articles.
+        incremental (bool, optional): Skip the records whose stored content_hash
+            matches their current text and html, and which were segmented by SEGMENT_VERSION.
+    """
+    vocabularies = load_vocabularies(get_vocabulary_collection(collection_read))
+    words, tags = vocabularies[WORD], vocabularies[POS]
+    records = collection_read.find(
+        {},
+        {"_id": 0, "title": 1, "text": 1, "html": 1, "content_hash": 1, "segment_version": 1},
+    )
+    skipped = 0
+
+    def flush_vocabularies():
+        # The new tokens are saved before the articles using them
+        words.flush()
+        tags.flush()
+
+    with BulkWriter(collection_read, before_flush=flush_vocabularies) as writer:
+        for record in tqdm(
+            instrumentation.timed_iter(records, f"mongo.read.{collection_read.name}"),
+            desc="Processing records segment",
+        ):
+            if "text" in record.keys():
+                record_hash = content_hash(record["text"], record.get("html", ""))
+                if (
+                    incremental
+                    and record.get("content_hash") == record_hash
+                    and record.get("segment_version") == SEGMENT_VERSION
+                ):
+                    skipped += 1
+                    continue
+                # Cut the 'text' field once into words, POS tags and sentence boundaries
+                tokens = instrumentation.call(
+                    "compute.tokenize_text", tokenize_text, record["text"]
+                )
+                new_record = {
+                    "token_ids": pack_array(words.encode(tokens["text_seg"])),
+                    "pos_ids": pack_array(tags.encode(tokens["pos_seg"], dtype=np.uint16)),
+                    "sentence_ends": pack_array(
+                        np.array(tokens["sentence_ends"], dtype=np.uint32)
+                    ),
+                    "title": record["title"],
+                    "content_hash": record_hash,
+                    "segment_version": SEGMENT_VERSION,
+                }
+                # Update the record in the collection
+                writer.add(
+                    UpdateOne(
+                        {"title": new_record["title"]},
+                        {"$set": new_record, "$unset": {"text_seg": "", "pos_seg": ""}},
+                        upsert=True,
+                    )
+                )
+            else:
+                tqdm.write(f"text field is not found in the title{record}")
+    print(
+        f"segment were successfully wrote: {writer.summary()}, skipped {skipped}, "
+        f"{len(words)} words and {len(tags)} tags in the vocabulary"
+    )
     return None
 
 
+def find_stale_titles(articles: PymongoCollection, indexs: PymongoCollection) -> list:
+    """
+    Finds the articles whose index record is missing, was calculated from another
+    content or by another METRICS_VERSION.
+
+    Only two projected scans are made, one over each collection, instead of
+    one query per article.
+
+    Args:
+        articles (PymongoCollection): The collection containing the segmented articles.
+        indexs (PymongoCollection): The collection containing the indexs.
+
+    Returns:
+        list: The titles of the stale articles.
+    """
+    calculated = {
+        record["title"]: (record.get("content_hash"), record.get("metrics_version"))
+        for record in indexs.find(
+            {}, {"_id": 0, "title": 1, "content_hash": 1, "metrics_version": 1}
+        )
+        if "title" in record
+    }
+    return [
+        record["title"]
+        for record in articles.find({}, {"_id": 0, "title": 1, "content_hash": 1})
+        if "title" in record
+        and (
+            record.get("content_hash") is None
+            or calculated.get(record["title"])
+            != (record["content_hash"], METRICS_VERSION)
+        )
+    ]
+
+
+def _find_by_titles(
+    collection: PymongoCollection, titles: list, projection: dict, chunk_size: int = 1000
+):
+    """
+    Reads the records of the given titles with one query per chunk of titles.
+    """
+    for start in range(0, len(titles), chunk_size):
+        chunk = titles[start : start + chunk_size]
+        yield from collection.find({"title": {"$in": chunk}}, projection)
+
+
+def load_index_resources() -> dict:
+    """
+    Loads the dictionaries needed by calculate_record.
+
+    Returns:
+        dict: A dictionary containing the rare words, the real POS dictionary,
+            the word dictionary, the medical words and the lexicon compiled from them.
+    """
+    rare_word = global_var.get_rare_list()
+    word_dict = global_var.get_word_dict()
+    medical_list = global_var.get_medical_list()
+    return {
+        "rare_word": rare_word,
+        "real_is_dict": global_var.get_real_pos(),
+        "word_dict": word_dict,
+        "medical_list": medical_list,
+        "lexicon": global_var.load_resource(
+            "index_lexicon",
+            ["data/word_dict.json", "data/rare_words.txt", global_var.medical_words_folder],
+            lambda: build_lexicon(word_dict, medical_list, rare_word),
+        ),
+    }
+
+
+def compile_id_resources(resources: dict, vocabularies: dict) -> dict:
+    """
+    Maps the dictionaries of load_index_resources to the ids of the vocabularies,
+    for the records segmented into 'token_ids' and 'pos_ids'.
+
+    Args:
+        resources (dict): The dictionaries returned by load_index_resources.
+        vocabularies (dict): The vocabularies returned by vocabulary.load_vocabularies.
+
+    Returns:
+        dict: A dictionary containing the characters of each token id ('token_lengths'),
+            the lexicon of compile_id_lexicon ('id_lexicon'), the token ids of the
+            conjunctions ('conjunction_ids') and the tag of each POS id ('pos_tags').
+    """
+    words = vocabularies[WORD]
+    conjunction_ids = words.lookup(set(resources["word_dict"]["conjunctions"]))
+    return {
+        "token_lengths": words.token_lengths(),
+        "id_lexicon": compile_id_lexicon(resources["lexicon"], words),
+        "conjunction_ids": conjunction_ids[conjunction_ids > 0],
+        "pos_tags": list(vocabularies[POS].tokens),
+    }
+
+
+def calculate_record(record: dict, resources: dict) -> dict:
+    """
+    Calculates all the indexs of one article.
+
+    Args:
+        record (dict): The article record, containing 'title', 'html', 'text', 'sentiment_list',
+            and 'token_ids' and 'pos_ids', or 'text_seg' and optionally 'pos_seg' for the
+            records segmented by the previous versions.
+        resources (dict): The dictionaries returned by load_index_resources, updated with
+            compile_id_resources for the records having 'token_ids'.
+
+    Returns:
+        dict: The index record of the article.
+    """
+    word_dict = resources["word_dict"]
+    new_record = {}
+    new_record.update(_metric(count_html_elements, record["html"]))
+    if "token_ids" in record:
+        token_ids = unpack_array(record["token_ids"])
+        new_record.update(
+            _metric(count_about_word_ids, token_ids, resources["token_lengths"])
+        )
+        # assertion, cite, level, concession, turning, metaphor, medical and rare in one pass
+        new_record.update(
+            _metric(count_lexicon_ids, token_ids, record["text"], resources["id_lexicon"])
+        )
+        new_record.update(
+            _metric(count_parallelism_ids, token_ids, resources["conjunction_ids"])
+        )
+        new_record.update(
+            _metric(count_pos_ids, unpack_array(record["pos_ids"]), resources["pos_tags"])
+        )
+    else:
+        new_record.update(_metric(count_about_word, record["text_seg"]))
+        new_record.update(
+            _metric(count_lexicon, record["text_seg"], record["text"], resources["lexicon"])
+        )
+        new_record.update(
+            _metric(count_parallelism, record["text_seg"], word_dict["conjunctions"])
+        )
+        if "pos_seg" in record:
+            new_record.update(_metric(count_pos_tags, record["pos_seg"]))
+        else:
+            new_record.update(_metric(count_word_pos, record["text"]))
+        # The tags are counted in pos_count, the list is not written to the indexs
+        new_record.pop("pos_list")
+    new_record.update(
+        _metric(count_is_real, new_record["pos_count"], resources["real_is_dict"])
+    )
+    new_record.update(_metric(count_sentiment, record["sentiment_list"]))
+    new_record.update(
+        _metric(count_about_sentence_pos_count, record["text"], new_record["pos_count"])
+    )
+    new_record.update(
+        _metric(
+            count_fog,
+            new_record["average_sentence_length"],
+            new_record["real_percentage"],
+        )
+    )
+    new_record["character_count"] = len(record["text"])
+    new_record["pos_len"] = len(new_record["pos_count"])
+    new_record["completely"] = True
+    new_record["title"] = record["title"]
+    new_record["content_hash"] = record.get("content_hash") or content_hash(
+        record["text"], record["html"]
+    )
+    new_record["metrics_version"] = METRICS_VERSION
+    return new_record
+
+
+def _metric(function, *args):
+    """
+    Calls a count_* function and records its duration as "metric.<function name>".
+    """
+    return instrumentation.call(f"metric.{function.__name__}", function, *args)
+
+
+# The dictionaries of a worker process, set once by _init_worker
+_worker_resources = None
+
+
+def _init_worker(resources: dict) -> None:
+    """
+    Sets the dictionaries of a worker process of calculate_all.
+
+    Args:
+        resources (dict): The dictionaries loaded by the main process, see calculate_all.
+    """
+    global _worker_resources
+    _worker_resources = resources
+    if multiprocessing.parent_process():
+        # Drop the timings a worker started by fork copied from the main process
+        instrumentation.collect()
+
+
+def _calculate_batch(records: list) -> tuple[list, list, dict]:
+    """
+    Calculates the indexs of a batch of articles in a worker process.
+
+    Args:
+        records (list): The article records of the batch.
+
+    Returns:
+        tuple[list, list, dict]: The index records, the error messages and the timings of the batch.
+            An error message holds the title and the traceback, reported by the main process.
+    """
+    new_records, errors = [], []
+    for record in records:
+        try:
+            new_records.append(calculate_record(record, _worker_resources))
+        except Exception:
+            errors.append(f"index error of {record.get('title')}:\n{traceback.format_exc()}")
+    # The timings of a worker process are sent back, the main process keeps its own
+    timings = instrumentation.collect() if multiprocessing.parent_process() else {}
+    return new_records, errors, timings
+
+
+def _calculate_parallel(records, workers: int, batch_size: int, resources: dict):
+    """
+    Calculates the indexs of the records in a process pool.
+
+    The cursor is read by the calling process and cut into batches, at most two
+    batches per worker are in flight so the memory does not grow with the corpus.
+    The workers are not forked: calculate_all runs in a thread of the pipeline while
+    other stages hold locks and connections, which a forked child would copy in their
+    current state and could wait on forever.
+
+    Args:
+        records: The article records to calculate.
+        workers (int): The number of worker processes.
+        batch_size (int): The number of records sent to a worker at once.
+        resources (dict): The dictionaries sent to every worker.
+
+    Yields:
+        tuple[list, list, dict]: The index records, the error messages and the timings of each batch.
+    """
+    pending = collections.deque()
+    start_method = (
+        "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    )
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context(start_method),
+        initializer=_init_worker,
+        initargs=(resources,),
+    ) as pool:
+        for batch in batched(records, batch_size):
+            pending.append(pool.submit(_calculate_batch, batch))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
 def calculate_all(
     articles: PymongoCollection,
     indexs: PymongoCollection,
     check_field_ignore: str = None,
     limit: int = None,
+    workers: int = 1,
+    batch_size: int = 64,
+    incremental: bool = False,
 ) -> None:
-    rare_word = global_var.get_rare_list()
-    real_is_dict = global_var.get_real_pos()
-    word_dict = global_var.get_word_dict()
-    medical_list = global_var.get_medical_list()
-    print("global var are successfully wrote")
+    """
+    Calculates the indexs of every article and writes them to the indexs collection.
+
+    Args:
+        articles (PymongoCollection): The collection containing the segmented articles.
+        indexs (PymongoCollection): The collection to write the indexs to.
+        check_field_ignore (str, optional): Skip the articles whose index record already has this field.
+        limit (int, optional): The maximum number of articles to calculate.
+        workers (int, optional): The number of worker processes. Defaults to 1, which
+            calculates in the current process.
+        batch_size (int, optional): The number of articles sent to a worker at once.
+        incremental (bool, optional): Only calculate the articles returned by find_stale_titles.
+
+    Returns:
+        None
+    """
+    projection = {
+        "_id": 0,
+        "title": 1,
+        "html": 1,
+        "text": 1,
+        "token_ids": 1,
+        "pos_ids": 1,
+        "text_seg": 1,
+        "pos_seg": 1,
+        "sentiment_list": 1,
+        "content_hash": 1,
+    }
+    if incremental:
+        titles = find_stale_titles(articles, indexs)
+        if limit is not None:
+            titles = titles[:limit]
+        print(f"{len(titles)} records are stale and will be calculated")
+        records = _find_by_titles(articles, titles, projection)
+        limit = len(titles)
+    else:
+        records = articles.find({}, projection)
+        if limit is not None:
+            records = records.limit(limit)
+    if check_field_ignore is not None:
+        # Fetch the titles to ignore in one query instead of one find_one per record
+        ignored_titles = {
+            record["title"]
+            for record in indexs.find(
+                {check_field_ignore: {"$exists": True}}, {"_id": 0, "title": 1}
+            )
+        }
+        records = (
+            record for record in records if record.get("title") not in ignored_titles
+        )
+    records = instrumentation.timed_iter(records, f"mongo.read.{articles.name}")
+    # The dictionaries and the vocabularies are loaded once here and sent to the workers
+    resources = load_index_resources()
+    resources.update(
+        compile_id_resources(
+            resources, load_vocabularies(get_vocabulary_collection(articles))
+        )
+    )
+    if workers > 1:
+        results = _calculate_parallel(records, workers, batch_size, resources)
+    else:
+        _init_worker(resources)
+        print("global var are successfully wrote")
+        results = map(_calculate_batch, batched(records, batch_size))
 
     # Start to calculate the index
-    bulk_updates = []
-    records = articles.find().limit(limit) if limit is not None else articles.find()
-    for record in tqdm(
-        records,
+    with BulkWriter(indexs) as writer, tqdm(
         desc="Processing records calculate",
         total=limit if limit is not None else 100000,
-    ):
-        try:
-            if (
-                check_field_ignore is not None
-                and indexs.find_one(
-                    {"title": record["title"], check_field_ignore: {"$exists": True}}
-                )
-                is not None
-            ):
-                continue
-            new_record = {}
-            new_record.update(count_html_elements(record["html"]))
-            new_record.update(count_about_word(record["text_seg"]))
-            new_record.update(count_about_structure(record["text_seg"], word_dict))
-            new_record.update(count_metaphor(record["text_seg"], word_dict["metaphor"]))
-            new_record.update(
-                count_parallelism(record["text_seg"], word_dict["conjunctions"])
-            )
-            new_record.update(count_medical(record["text_seg"], medical_list))
-            new_record.update(count_word_pos(record["text"]))
-            new_record.update(count_rare(record["text"], rare_word))
-            new_record.update(count_is_real(new_record["pos_count"], real_is_dict))
-            new_record.update(count_sentiment(record["sentiment_list"]))
-            new_record.update(
-                count_about_sentence(record["text"], new_record["pos_list"])
-            )
-            new_record.update(
-                count_fog(
-                    new_record["average_sentence_length"], new_record["real_percentage"]
-                )
-            )
-            new_record["character_count"] = len(record["text"])
-            new_record["pos_len"] = len(new_record["pos_count"])
-            new_record["completely"] = True
-            new_record["title"] = record["title"]
-            # tqdm.write(str(new_record))
-            # indexs.update_one({"title": new_record["title"]}, {"$set": new_record}, upsert=True)
-            bulk_updates.append(
-                pymongo.UpdateOne(
-                    {"title": new_record["title"]}, {"$set": new_record}, upsert=True
-                )
-            )
-        except Exception as e:
-            tqdm.write(str(e))
-    print("all records were successfully calculated and starting to wrote them")
-    if bulk_updates:
-        indexs.bulk_write(bulk_updates, ordered=False)
-    print("all records were successfully wrote")
+    ) as pbar:
+        for new_records, errors, timings in results:
+            instrumentation.merge(timings)
+            for error in errors:
+                tqdm.write(error)
+            for new_record in new_records:
+                writer.upsert({"title": new_record["title"]}, new_record)
+            pbar.update(len(new_records) + len(errors))
+    print(f"all records were successfully calculated and wrote: {writer.summary()}")
 
 
 if __name__ == "__main__":
@@ -1,90 +1,332 @@
 import collections
 import os
+import numpy as np
 import pymongo
 import pymongo.collection
-from sentence_transformers import SentenceTransformer
-from bertopic import BERTopic
 from tqdm import tqdm
 import global_var
-import torch
-from cuml.manifold import UMAP
-from cuml.cluster import HDBSCAN
-from sklearn.feature_extraction.text import CountVectorizer
 from global_var import topic_model_path
+from process_mongo import BulkWriter, batched, pack_array
+from embedding_cache import get_embeddings
 
-# Prepare sub-models
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
 
+# torch, sentence_transformers, bertopic, cuml and sklearn are imported in the functions
+# fitting or loading the topic model, so importing this module (and main.py) stays cheap
 
-def count_topic(articles: list[str], info_dict: dict) -> int:
+
+def count_topic_by_position(topics: list, paragraph_counts: list) -> list[int]:
     """
-    Counts the number of unique topics in a list of articles.
+    Counts the number of unique topics of each article from the topics of all their paragraphs.
 
     Args:
-        articles (list[str]): A list of article names.
-        info_dict (dict): A dictionary mapping article names to their corresponding topics.
+        topics (list): The topic of each paragraph, the paragraphs of an article are contiguous.
+        paragraph_counts (list): The number of paragraphs of each article.
 
     Returns:
-        int: The number of unique topics in the given list of articles.
+        list[int]: The number of unique topics of each article.
     """
-    topics = [info_dict[article] for article in articles]
-    return len(set(topics))
+    counts = []
+    start = 0
+    for paragraph_count in paragraph_counts:
+        counts.append(len(set(topics[start : start + paragraph_count])))
+        start += paragraph_count
+    return counts
 
 
 def count_topic_all(
     read_collection: pymongo.collection.Collection,
     wrote_collection: pymongo.collection.Collection,
+    batch_size: int = 1000,
+    store_distribution: bool = False,
 ) -> None:
     """
-    Fit BERTopic without actually performing any clustering.
+    Writes the number of topics of each article, fitting the topic model if it is not saved yet.
+    When the model is saved, only the articles without count_topic are assigned by assign_topics.
 
     Args:
         read_collection: Collection to read data from.
         wrote_collection: Collection to write data to.
+        batch_size (int, optional): The number of articles written at once.
+        store_distribution (bool, optional): Also write the topic of each paragraph and the
+            topic distribution of each paragraph, see _write_topic_batch.
 
     Returns:
         None
     """
-    # Fit BERTopic without actually performing any clustering
+    if os.path.exists(topic_model_path):
+        assign_topics(
+            read_collection,
+            wrote_collection,
+            batch_size,
+            only_missing=True,
+            store_distribution=store_distribution,
+        )
+        return None
     records = read_collection.find({}, {"_id": 0, "title": 1, "text": 1})
     articles = []
-    title2articles = {}
+    titles = []
+    paragraphs_list = []
     for record in records:
-        paragraphs = record["text"].split("\n")
-        paragraphs = [paragraph for paragraph in paragraphs if len(paragraph) >= 6]
-        title2articles[record["title"]] = paragraphs
+        paragraphs = split_paragraphs(record["text"])
+        titles.append(record["title"])
+        paragraphs_list.append(paragraphs)
         articles.extend(paragraphs)
-    if os.path.exists(topic_model_path):
-        topic_model = BERTopic.load("topic_model.bin")
-        print("Topic model saved at topic_model.bin")
-    else:
-        topic_model = model_fit_save(articles, topic_model_path)
-    bulk_updates = []
-    info_df = topic_model.get_document_info(articles)
-    info_dict = info_df[["Document", "Topic"]].set_index("Document")["Topic"].to_dict()
-    for title in tqdm(
-        title2articles.keys(),
-        desc="Processing records topic count",
-        total=len(title2articles.keys()),
-    ):
-        articles = title2articles[title]
-        new_record = {"title": title, "count_topic": count_topic(articles, info_dict)}
-        wrote_collection.update_one(
-            {"title": new_record["title"]}, {"$set": new_record}, upsert=True
-        )
+    topic_model = model_fit_save(articles, topic_model_path)
+    # topics_ follows the order of the fitted paragraphs, so map them back by position
+    topics = list(topic_model.topics_)
+    with BulkWriter(wrote_collection) as writer, tqdm(
+        desc="Processing records topic count", total=len(titles)
+    ) as pbar:
+        paragraph_start = 0
+        for start in range(0, len(titles), batch_size):
+            batch_paragraphs = paragraphs_list[start : start + batch_size]
+            paragraph_end = paragraph_start + sum(map(len, batch_paragraphs))
+            _write_topic_batch(
+                writer,
+                topic_model,
+                titles[start : start + batch_size],
+                batch_paragraphs,
+                topics[paragraph_start:paragraph_end],
+                store_distribution,
+            )
+            paragraph_start = paragraph_end
+            pbar.update(len(batch_paragraphs))
+    print(f"topic count were successfully wrote: {writer.summary()}")
     return None
 
 
-def model_fit_save(articles: list, model_path: str) -> BERTopic:
+def assign_topics(
+    read_collection: pymongo.collection.Collection,
+    wrote_collection: pymongo.collection.Collection,
+    batch_size: int = 1000,
+    only_missing: bool = True,
+    model_path: str = topic_model_path,
+    store_distribution: bool = False,
+) -> None:
+    """
+    Assigns the topics of articles with the saved topic model, without fitting it again.
+
+    The model is loaded once and the articles are transformed in batches, the paragraphs
+    are mapped back to their article by position and count_topic is written after each batch.
+
+    Args:
+        read_collection: Collection to read the articles from.
+        wrote_collection: Collection to write count_topic to.
+        batch_size (int, optional): The number of articles transformed at once.
+        only_missing (bool, optional): Only assign the articles without count_topic in wrote_collection.
+        model_path (str, optional): The path of the saved BERTopic model.
+        store_distribution (bool, optional): Also write the topic of each paragraph and the
+            topic distribution of each paragraph, see _write_topic_batch.
+
+    Returns:
+        None
+    """
+    import torch
+    from bertopic import BERTopic
+    from sentence_transformers import SentenceTransformer
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    embedding_model = SentenceTransformer(EMBEDDING_MODEL_NAME, device=device)
+    topic_model = BERTopic.load(model_path, embedding_model=embedding_model)
+    print(f"Topic model loaded from {model_path}")
+    assigned_titles = set()
+    if only_missing:
+        assigned_titles = {
+            record["title"]
+            for record in wrote_collection.find(
+                {"count_topic": {"$exists": True}}, {"_id": 0, "title": 1}
+            )
+        }
+    records = read_collection.find({}, {"_id": 0, "title": 1, "text": 1})
+    records = (record for record in records if record["title"] not in assigned_titles)
+    with BulkWriter(wrote_collection) as writer, tqdm(
+        desc="Processing records topic assign"
+    ) as pbar:
+        for batch in batched(records, batch_size):
+            paragraphs_list = [split_paragraphs(record["text"]) for record in batch]
+            paragraphs = [
+                paragraph for article in paragraphs_list for paragraph in article
+            ]
+            topics = []
+            if paragraphs:
+                embeddings = get_embeddings(
+                    paragraphs, embedding_model, EMBEDDING_MODEL_NAME, device=device
+                )
+                topics, _ = topic_model.transform(paragraphs, embeddings)
+            _write_topic_batch(
+                writer,
+                topic_model,
+                [record["title"] for record in batch],
+                paragraphs_list,
+                list(topics),
+                store_distribution,
+            )
+            pbar.update(len(batch))
+    print(f"topic count were successfully wrote: {writer.summary()}")
+    return None
+
+
+def _write_topic_batch(
+    writer: BulkWriter,
+    topic_model,
+    titles: list,
+    paragraphs_list: list,
+    topics: list,
+    store_distribution: bool,
+) -> None:
+    """
+    Writes count_topic for a batch of articles.
+
+    With store_distribution, 'paragraph_topics' (the topic of each paragraph) and
+    'topic_distribution' (a float16 array of shape (paragraphs, topics) packed by
+    process_mongo.pack_array, from BERTopic.approximate_distribution) are written too.
+
+    Args:
+        writer (BulkWriter): The writer of the collection.
+        topic_model (BERTopic): The fitted topic model.
+        titles (list): The titles of the articles.
+        paragraphs_list (list): The paragraphs of each article.
+        topics (list): The topic of each paragraph of the batch, in order.
+        store_distribution (bool): Whether to write the paragraph topics and distributions.
+
+    Returns:
+        None
+    """
+    paragraph_counts = [len(paragraphs) for paragraphs in paragraphs_list]
+    counts = count_topic_by_position(topics, paragraph_counts)
+    distribution = None
+    if store_distribution and topics:
+        paragraphs = [paragraph for article in paragraphs_list for paragraph in article]
+        distribution, _ = topic_model.approximate_distribution(paragraphs)
+        distribution = np.asarray(distribution, dtype=np.float16)
+    start = 0
+    for title, paragraph_count, topic_count in zip(titles, paragraph_counts, counts):
+        new_record = {"title": title, "count_topic": topic_count}
+        if store_distribution:
+            end = start + paragraph_count
+            new_record["paragraph_topics"] = [int(topic) for topic in topics[start:end]]
+            new_record["topic_distribution"] = pack_array(
+                distribution[start:end]
+                if distribution is not None
+                else np.zeros((0, 0), dtype=np.float16)
+            )
+            start = end
+        writer.upsert({"title": title}, new_record)
+
+
+def split_paragraphs(text: str) -> list[str]:
+    """
+    Splits an article into the paragraphs used by the topic model.
+
+    Args:
+        text (str): The text of the article.
+
+    Returns:
+        list[str]: The lines of the text which have at least 6 characters.
+    """
+    return [paragraph for paragraph in text.split("\n") if len(paragraph) >= 6]
+
+
+def select_topic_backend(backend: str = None) -> str:
+    """
+    Chooses the backend reducing and clustering the embeddings of the topic model.
+
+    Args:
+        backend (str, optional): "cuml" (GPU UMAP and HDBSCAN), "cpu" (umap-learn and hdbscan),
+            "fast" (PCA and MiniBatchKMeans from sklearn) or "auto", which takes the first
+            one that can be imported. Defaults to global_var.topic_backend.
+
+    Returns:
+        str: The name of the backend.
+    """
+    backend = backend or global_var.topic_backend
+    if backend != "auto":
+        return backend
+    try:
+        import cuml  # noqa: F401
+
+        return "cuml"
+    except ImportError:
+        pass
+    try:
+        import hdbscan  # noqa: F401
+        import umap  # noqa: F401
+
+        return "cpu"
+    except ImportError:
+        return "fast"
+
+
+def get_topic_sub_models(backend: str = None) -> tuple:
+    """
+    Builds the dimensionality reduction and the clustering models of a backend.
+
+    Args:
+        backend (str, optional): The backend, see select_topic_backend.
+
+    Returns:
+        tuple: The umap_model and the hdbscan_model given to BERTopic.
+    """
+    backend = select_topic_backend(backend)
+    print(f"topic backend: {backend}")
+    if backend == "cuml":
+        from cuml.cluster import HDBSCAN
+        from cuml.manifold import UMAP
+
+        umap_model = UMAP(
+            n_components=5, n_neighbors=50, random_state=42, metric="cosine", verbose=True
+        )
+        hdbscan_model = HDBSCAN(
+            min_samples=20,
+            gen_min_span_tree=True,
+            prediction_data=True,
+            min_cluster_size=20,
+            verbose=True,
+        )
+    elif backend == "cpu":
+        from hdbscan import HDBSCAN
+        from umap import UMAP
+
+        umap_model = UMAP(
+            n_components=5, n_neighbors=50, random_state=42, metric="cosine", verbose=True
+        )
+        hdbscan_model = HDBSCAN(
+            min_samples=20,
+            gen_min_span_tree=True,
+            prediction_data=True,
+            min_cluster_size=20,
+        )
+    elif backend == "fast":
+        from sklearn.cluster import MiniBatchKMeans
+        from sklearn.decomposition import PCA
+
+        umap_model = PCA(n_components=5, random_state=42)
+        hdbscan_model = MiniBatchKMeans(
+            n_clusters=global_var.topic_fast_clusters, random_state=42, n_init=3
+        )
+    else:
+        raise ValueError(f"unknown topic backend: {backend}")
+    return umap_model, hdbscan_model
+
+
+def model_fit_save(articles: list, model_path: str, backend: str = None) -> "BERTopic":
     """
     Fits a BERTopic model to a list of articles and saves the model to a specified path.
     Args:
         articles (list): A list of articles.
         model_path (str): The path to save the BERTopic model.
+        backend (str, optional): The backend of the sub-models, see select_topic_backend.
     Returns:
         BERTopic: The fitted BERTopic model.
     Raises:
-        None
+        ValueError: If the backend is unknown.
     """
+    import torch
+    from bertopic import BERTopic
+    from sentence_transformers import SentenceTransformer
+    from sklearn.feature_extraction.text import CountVectorizer
+
     # Extract vocab to be used in BERTopic
     vocab = collections.Counter()
     tokenizer = CountVectorizer().build_tokenizer()
@@ -93,18 +335,10 @@ def model_fit_save(articles: list, model_path: str) -> BERTopic:
     vocab = [word for word, frequency in vocab.items() if frequency >= 15]
     len(vocab)
     stop_words = global_var.get_stop_word()
-    embedding_model = SentenceTransformer("all-MiniLM-L6-v2")
-    umap_model = UMAP(
-        n_components=5, n_neighbors=50, random_state=42, metric="cosine", verbose=True
-    )
-    hdbscan_model = HDBSCAN(
-        min_samples=20,
-        gen_min_span_tree=True,
-        prediction_data=False,
-        min_cluster_size=20,
-        verbose=True,
-    )
-    vectorizer_model = CountVectorizer(vocabulary=vocab, stop_words=stop_words)
+    embedding_model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+    umap_model, hdbscan_model = get_topic_sub_models(backend)
+    # The stop words are shared by load_resource, the vectorizer is saved with the model
+    vectorizer_model = CountVectorizer(vocabulary=vocab, stop_words=list(stop_words))
     topic_model = BERTopic(
         # Pipeline models
         embedding_model=embedding_model,
@@ -122,7 +356,14 @@ def model_fit_save(articles: list, model_path: str) -> BERTopic:
     else:
         device = torch.device("cpu")
         print("cuda is unavailable")
-    embeddings = embedding_model.encode(articles, show_progress_bar=True, device=device)
+    # Only the paragraphs missing from the embedding cache are encoded
+    embeddings = get_embeddings(
+        articles,
+        embedding_model,
+        EMBEDDING_MODEL_NAME,
+        show_progress_bar=True,
+        device=device,
+    )
     print("start create topic .....")
     topic_model.fit_transform(articles, embeddings)
     topic_model.save(model_path)
@@ -0,0 +1,181 @@
+'''
+it is a file that contains the on-disk cache of the paragraph embeddings used by the topic model.
+Notes:
+1. every embedding model has its own folder in global_var.embedding_cache_folder, with the float32 rows in embeddings.f32, the sha1 of the paragraph of each row in index.txt and the width of the rows in meta.json.
+2. the rows are only appended, chunk by chunk, so an interrupted run keeps the embeddings of the chunks already encoded, and the rows are read back through a memory map.
+3. the index of a cache is read once per process and kept up to date by the appends, it is read again only when another process appended rows.
+'''
+
+
+import hashlib
+import json
+import os
+import numpy as np
+import global_var
+from process_mongo import batched
+
+# The number of paragraphs encoded before they are appended to the cache
+EMBEDDING_CHUNK_SIZE = 4096
+# The length of a line of index.txt, a sha1 hex digest and a newline
+INDEX_LINE_WIDTH = 41
+
+# The index of each cache read by this process, folder -> (index, dimension, row count)
+_indexes = {}
+
+
+def paragraph_hash(paragraph: str) -> str:
+    """
+    Calculates the key of a paragraph in the cache.
+
+    Args:
+        paragraph (str): The paragraph.
+
+    Returns:
+        str: The hex sha1 digest of the paragraph.
+    """
+    return hashlib.sha1(paragraph.encode("utf-8")).hexdigest()
+
+
+def _cache_paths(model_name: str, cache_folder: str) -> dict:
+    """
+    Returns the paths of the files of the cache of an embedding model.
+    """
+    folder = os.path.join(cache_folder, model_name.replace("/", "_"))
+    return {
+        "folder": folder,
+        "embeddings": os.path.join(folder, "embeddings.f32"),
+        "index": os.path.join(folder, "index.txt"),
+        "meta": os.path.join(folder, "meta.json"),
+    }
+
+
+def load_index(model_name: str, cache_folder: str = None) -> tuple[dict, int]:
+    """
+    Loads the index of the cache of an embedding model.
+
+    Args:
+        model_name (str): The name of the embedding model.
+        cache_folder (str, optional): Defaults to global_var.embedding_cache_folder.
+
+    Returns:
+        tuple[dict, int]: A dictionary mapping each paragraph hash to its row,
+            and the width of the rows (0 when the cache is empty).
+    """
+    paths = _cache_paths(model_name, cache_folder or global_var.embedding_cache_folder)
+    if not os.path.exists(paths["meta"]):
+        return {}, 0
+    with open(paths["meta"], "r") as file:
+        dimension = json.load(file)["dimension"]
+    row_count = _row_count(paths, dimension)
+    index = {}
+    with open(paths["index"], "r") as file:
+        for row, line in enumerate(file):
+            if row >= row_count:
+                break
+            index.setdefault(line.strip(), row)
+    return index, dimension
+
+
+def _row_count(paths: dict, dimension: int) -> int:
+    """
+    Returns the number of rows completely written in the embeddings file, 0 when the cache is empty.
+    """
+    if dimension <= 0 or not os.path.exists(paths["embeddings"]):
+        return 0
+    return os.path.getsize(paths["embeddings"]) // (4 * dimension)
+
+
+def _load_index_cached(model_name: str, cache_folder: str) -> tuple[dict, int, int]:
+    """
+    Returns the index, the width and the number of rows of a cache, the index is only read
+    again when another process appended rows since it was last read by this process.
+    An empty cache is not kept, so the rows appended later by any process are found.
+    """
+    paths = _cache_paths(model_name, cache_folder)
+    cached = _indexes.get(paths["folder"])
+    if cached is not None and _row_count(paths, cached[1]) == cached[2]:
+        return cached
+    index, dimension = load_index(model_name, cache_folder)
+    row_count = _row_count(paths, dimension)
+    if dimension:
+        _indexes[paths["folder"]] = (index, dimension, row_count)
+    else:
+        _indexes.pop(paths["folder"], None)
+    return index, dimension, row_count
+
+
+def get_embeddings(
+    paragraphs: list,
+    embedding_model,
+    model_name: str,
+    cache_folder: str = None,
+    chunk_size: int = EMBEDDING_CHUNK_SIZE,
+    **encode_kwargs,
+) -> np.ndarray:
+    """
+    Returns the embeddings of the paragraphs, only the paragraphs missing from the cache are encoded.
+
+    The missing paragraphs are encoded and appended to the cache chunk_size at a time,
+    so an interrupted encoding keeps the chunks already encoded.
+
+    Args:
+        paragraphs (list): The paragraphs to embed.
+        embedding_model: The SentenceTransformer used for the missing paragraphs.
+        model_name (str): The name of the embedding model, each model has its own cache.
+        cache_folder (str, optional): Defaults to global_var.embedding_cache_folder.
+        chunk_size (int, optional): The number of paragraphs encoded before they are written.
+        **encode_kwargs: Passed to embedding_model.encode, e.g. device or show_progress_bar.
+
+    Returns:
+        np.ndarray: A float32 array of shape (len(paragraphs), dimension).
+    """
+    cache_folder = cache_folder or global_var.embedding_cache_folder
+    paths = _cache_paths(model_name, cache_folder)
+    index, dimension, row_count = _load_index_cached(model_name, cache_folder)
+    hashes = [paragraph_hash(paragraph) for paragraph in paragraphs]
+    missing = {}
+    for paragraph_key, paragraph in zip(hashes, paragraphs):
+        if paragraph_key not in index and paragraph_key not in missing:
+            missing[paragraph_key] = paragraph
+    print(f"{len(paragraphs) - len(missing)} paragraphs found in the embedding cache")
+    for chunk in batched(missing.items(), chunk_size):
+        new_embeddings = np.asarray(
+            embedding_model.encode([paragraph for _, paragraph in chunk], **encode_kwargs),
+            dtype=np.float32,
+        )
+        os.makedirs(paths["folder"], exist_ok=True)
+        if dimension == 0:
+            dimension = new_embeddings.shape[1]
+            # Drop the rows of a previous run which wrote no meta.json
+            open(paths["embeddings"], "wb").close()
+            open(paths["index"], "w").close()
+            with open(paths["meta"], "w") as file:
+                json.dump({"model_name": model_name, "dimension": dimension}, file)
+        # The index is written first, a row is only valid once its embedding is written.
+        # The lines have a fixed width, so the lines of the rows an interrupted run did
+        # not write are dropped without reading the index.
+        with open(paths["index"], "a") as file:
+            file.truncate(row_count * INDEX_LINE_WIDTH)
+            file.writelines(f"{paragraph_key}\n" for paragraph_key, _ in chunk)
+        with open(paths["embeddings"], "ab") as file:
+            # Drop a partially written row of an interrupted run
+            file.truncate(row_count * 4 * dimension)
+            file.write(new_embeddings.tobytes())
+        for offset, (paragraph_key, _) in enumerate(chunk):
+            index[paragraph_key] = row_count + offset
+        row_count += len(chunk)
+        _indexes[paths["folder"]] = (index, dimension, row_count)
+    if not paragraphs:
+        return np.zeros((0, dimension), dtype=np.float32)
+    cached = np.memmap(
+        paths["embeddings"],
+        dtype=np.float32,
+        mode="r",
+        shape=(row_count, dimension),
+    )
+    return np.asarray(cached[[index[paragraph_key] for paragraph_key in hashes]])
+
+
+if __name__ == "__main__":
+    for model_name in os.listdir(global_var.embedding_cache_folder):
+        print(model_name, len(load_index(model_name)[0]))
@@ -0,0 +1,288 @@
+'''
+it is a file that contains the export of the mongo collections to parquet files for analysis.
+Notes:
+1. the collection is read in chunks with a projection and every chunk is written to its own part file, so the memory does not grow with the collection.
+2. the columns of indexs have the types declared in INDEX_FIELD_TYPES, renamed through the field map, so every export has the same schema. The schema of other collections is inferred chunk by chunk, a column whose type is promoted by a later chunk (int to float, mixed types to string) is rewritten in the parts written before, so every part has the same schema.
+3. the parts are written to a temporary folder which replaces the previous export once the export succeeded.
+4. pyarrow is only imported when exporting.
+'''
+
+
+import json
+import os
+import shutil
+import time
+from pymongo.database import Database
+from tqdm import tqdm
+import global_var
+from process_mongo import batched
+
+# The type of each field of the indexs collection, "json" fields are written as JSON strings
+INDEX_FIELD_TYPES = {
+    "title": "string",
+    "unique_word_percentage": "float",
+    "word_ratio": "float",
+    "real_percentage": "float",
+    "pos_count": "json",
+    "cohesive": "float",
+    "mark_radio": "float",
+    "long_sentence_count": "int",
+    "short_sentence_count": "int",
+    "average_word_length": "float",
+    "average_sentence_length": "float",
+    "rare_percentage": "float",
+    "fog": "float",
+    "sentenced_length_dev": "float",
+    "v_a": "float",
+    "break": "float",
+    "sentiment_score": "int",
+    "sentiment_variety": "int",
+    "parallelism": "int",
+    "metaphor": "int",
+    "assertion": "int",
+    "cite": "int",
+    "level": "int",
+    "turning": "int",
+    "concession": "int",
+    "medical": "int",
+    "total_word_count": "int",
+    "sentence_count": "int",
+    "entropy": "float",
+    "video": "int",
+    "audio": "int",
+    "images": "int",
+    "links": "int",
+    "paragraphs": "int",
+    "tables": "int",
+    "character_count": "int",
+    "non_repeating_word_count": "int",
+    "pos_len": "int",
+    "count_topic": "int",
+}
+
+
+def _arrow_type(type_name: str):
+    """
+    Returns the pyarrow type of a type name of INDEX_FIELD_TYPES.
+    """
+    import pyarrow as pa
+
+    return {
+        "string": pa.string(),
+        "json": pa.string(),
+        "int": pa.int64(),
+        "float": pa.float64(),
+        "bool": pa.bool_(),
+    }[type_name]
+
+
+def _convert(value, type_name: str):
+    """
+    Converts a field value to the python type of its column, None stays None.
+    """
+    if value is None:
+        return None
+    if type_name == "json":
+        return json.dumps(value, ensure_ascii=False, default=str)
+    if type_name == "int":
+        return int(value)
+    if type_name == "float":
+        return float(value)
+    if type_name == "bool":
+        return bool(value)
+    return str(value)
+
+
+def _promote(previous: str, type_name: str) -> str:
+    """
+    Returns the type name of a column holding the values of two type names,
+    int and float give float and the other different types give string.
+    """
+    if previous is None or previous == type_name:
+        return type_name
+    if {previous, type_name} == {"int", "float"}:
+        return "float"
+    return "string"
+
+
+def _infer_types(documents: list, field_types: dict = None) -> dict:
+    """
+    Infers the type name of every field of a chunk of documents, promoted with the
+    types inferred from the previous chunks.
+    """
+    field_types = dict(field_types or {})
+    for document in documents:
+        for field, value in document.items():
+            if value is None:
+                continue
+            if isinstance(value, bool):
+                type_name = "bool"
+            elif isinstance(value, int):
+                type_name = "int"
+            elif isinstance(value, float):
+                type_name = "float"
+            elif isinstance(value, (dict, list)):
+                type_name = "json"
+            else:
+                type_name = "string"
+            field_types[field] = _promote(field_types.get(field), type_name)
+    return field_types
+
+
+def _get_columns(field_types: dict, field_mapping: dict = None) -> dict:
+    """
+    Returns a dictionary mapping each exported field to its column name and type name,
+    the fields without a type (never seen yet) are strings.
+    """
+    fields = list(field_mapping) if field_mapping is not None else list(field_types)
+    return {
+        field: (
+            field_mapping[field] if field_mapping is not None else field,
+            field_types.get(field) or "string",
+        )
+        for field in fields
+    }
+
+
+def export_parquet(
+    database: Database,
+    collection_name: str,
+    output_folder: str,
+    field_mapping: dict = None,
+    field_types: dict = None,
+    chunk_size: int = 10000,
+) -> int:
+    """
+    Streams a collection into partitioned parquet files with a stable schema.
+
+    The files are written to output_folder/collection_name/part-00000.parquet, ...
+    The parts are written to a temporary folder which replaces the previous export of the
+    collection only once every part is written, a failed export keeps the previous one.
+
+    Args:
+        database (Database): The MongoDB database.
+        collection_name (str): The name of the collection to export.
+        output_folder (str): The folder of the exports.
+        field_mapping (dict, optional): A dictionary mapping fields to column names, like
+            global_var.get_field_map(). Only the mapped fields are exported when it is given.
+        field_types (dict, optional): The type of each field, see INDEX_FIELD_TYPES.
+            The types are inferred from the documents when it is None: an int column
+            holding a float becomes a float column, other mixed types become strings,
+            and the parts written before a column changed are rewritten with its new type.
+        chunk_size (int, optional): The number of documents of each part file.
+
+    Returns:
+        int: The number of exported documents.
+    """
+    start_time = time.monotonic()
+    collection_folder = os.path.join(output_folder, collection_name)
+    temporary_folder = os.path.join(output_folder, f".{collection_name}.tmp")
+    shutil.rmtree(temporary_folder, ignore_errors=True)
+    os.makedirs(temporary_folder)
+    projection = {"_id": 0}
+    if field_mapping is not None:
+        projection.update({field: 1 for field in field_mapping})
+    elif field_types is not None:
+        projection.update({field: 1 for field in field_types})
+    cursor = database[collection_name].find({}, projection).batch_size(chunk_size)
+    inferred = field_types is None
+    types = {} if inferred else field_types
+    # The types each part was written with, to rewrite the parts whose types were promoted
+    part_types = []
+    document_count = 0
+    try:
+        with tqdm(desc=f"Exporting {collection_name}") as pbar:
+            for chunk in batched(cursor, chunk_size):
+                if inferred:
+                    types = _infer_types(chunk, types)
+                _write_part(
+                    chunk, temporary_folder, len(part_types), _get_columns(types, field_mapping)
+                )
+                part_types.append(types)
+                document_count += len(chunk)
+                pbar.update(len(chunk))
+        if not part_types:
+            _write_part([], temporary_folder, 0, _get_columns(types, field_mapping))
+        columns = _get_columns(types, field_mapping)
+        for part, written_types in enumerate(part_types):
+            if written_types != types:
+                _rewrite_part(temporary_folder, part, columns)
+        if os.path.exists(collection_folder):
+            previous_folder = os.path.join(output_folder, f".{collection_name}.previous")
+            shutil.rmtree(previous_folder, ignore_errors=True)
+            os.rename(collection_folder, previous_folder)
+            os.rename(temporary_folder, collection_folder)
+            shutil.rmtree(previous_folder)
+        else:
+            os.rename(temporary_folder, collection_folder)
+    finally:
+        shutil.rmtree(temporary_folder, ignore_errors=True)
+    # The rate is calculated from the rounded seconds like BulkWriter.summary
+    elapsed = round(time.monotonic() - start_time, 1)
+    docs_per_sec = document_count / elapsed if elapsed > 0 else 0.0
+    print(
+        f"{document_count} documents of {collection_name} exported to {collection_folder} "
+        f"in {elapsed:.1f}s ({docs_per_sec:.1f} docs/sec)"
+    )
+    return document_count
+
+
+def _write_part(chunk: list, folder: str, part: int, columns: dict) -> None:
+    """
+    Writes a chunk of documents to a part file.
+
+    Args:
+        chunk (list): The documents.
+        folder (str): The folder of the part files.
+        part (int): The number of the part.
+        columns (dict): A dictionary mapping each field to its column name and type name,
+            see _get_columns.
+
+    Returns:
+        None
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema(
+        [(name, _arrow_type(type_name)) for name, type_name in columns.values()]
+    )
+    extra_fields = {field for document in chunk for field in document} - set(columns)
+    if extra_fields:
+        tqdm.write(f"fields not in the schema are skipped: {sorted(extra_fields)}")
+    table = pa.Table.from_pydict(
+        {
+            name: [_convert(document.get(field), type_name) for document in chunk]
+            for field, (name, type_name) in columns.items()
+        },
+        schema=schema,
+    )
+    pq.write_table(table, os.path.join(folder, f"part-{part:05d}.parquet"))
+
+
+def _rewrite_part(folder: str, part: int, columns: dict) -> None:
+    """
+    Writes a part file again with the final columns, converting its values to their
+    promoted types and adding the columns found after it was written.
+    """
+    import pyarrow.parquet as pq
+
+    rows = pq.read_table(os.path.join(folder, f"part-{part:05d}.parquet")).to_pylist()
+    chunk = [
+        {field: row.get(name) for field, (name, _) in columns.items()} for row in rows
+    ]
+    _write_part(chunk, folder, part, columns)
+
+
+if __name__ == "__main__":
+    from process_mongo import get_db
+
+    database = get_db()
+    export_parquet(
+        database,
+        "indexs",
+        global_var.parquet_export_folder,
+        global_var.get_field_map(),
+        INDEX_FIELD_TYPES,
+    )
+    export_parquet(database, "demands", global_var.parquet_export_folder)
@@ -2,22 +2,130 @@
 it is a file that contains global variables and functions that are used in multiple files.
 Notes:
 1. the mongo database is only available in our lan network, so the client_url is not accessible. And if you want to use the mongo database, you need to change the client_url to your own.
+   the client_url can also be "sqlite:///data/local.db" or "memory://" to run the pipeline without mongo, see storage.py.
 2. the health_articles_folder_path is the path to the folder containing the health articles. We offer some test articles in the default folder, you can change it to your own folder. 
 3. the topic model is too large to upload to the github, so you need to train the topic model by yourself and choose a path to save the model.
+   the topic_backend can be "cuml" (GPU), "cpu" (umap-learn and hdbscan), "fast" (PCA and MiniBatchKMeans) or "auto".
+4. the resources (stop words, dictionaries, ...) are loaded at most once per process by load_resource, and a pickled copy is kept in resource_cache_folder, it is rebuilt when the size or modification time of a source file changes.
+   every caller gets the same object, so the resources are read-only: a caller which needs to change one must copy it first, otherwise the change is seen by every later caller of the process.
 '''
 
 
 import json
 import os
+import pickle
 import pandas as pd
 
 
 SENTENCE_SPLIT = r"[。.!?！？]"
 LONG2SHORT = 10
+BULK_BATCH_SIZE = 1000
+BULK_FLUSH_INTERVAL = 30
+# The operations slower than this many milliseconds are recorded by the profiler
+SLOW_QUERY_MS = 100
+# The tags counted by calculate_index.count_html_elements for each index
+HTML_ELEMENTS = {
+    "images": ["img"],
+    "audio": ["audio"],
+    "video": ["video"],
+    "paragraphs": ["p"],
+    "tables": ["table"],
+    "links": ["a"],
+}
 topic_model_path = "/workspace/model/health_article_topic_model.bin"
+embedding_cache_folder = "/workspace/model/embedding_cache"
+topic_backend = "auto"
+topic_fast_clusters = 100
 client_url = "mongodb://10.48.48.7:27017/"
 database_name = "health_articles"
 health_articles_folder_path = "/workspace/dataset/health/article"
+index_workers = os.cpu_count() or 1
+ingest_workers = 16
+parquet_export_folder = "/workspace/dataset/health/parquet"
+resource_cache_folder = "data/resource_cache"
+# The folder of the .txt lists of medical words, data/medical_words holds a small sample of them
+medical_words_folder = "chinese_medical_words"
+# The collection keeping the checkpoints of the resumable passes over the database
+metadata_collection_name = "pipeline_metadata"
+# The collection mapping the tokens and the POS tags to the ids stored by the segment stage
+vocabulary_collection_name = "vocabulary"
+pipeline_workers = 2
+# Record the slow queries with the mongo profiler during a run of main.py, the profiler slows
+# down every client of the database, its previous level is restored at the end of the run
+profile_slow_queries = False
+instrumentation_report_path = "data/instrumentation.json"
+# Set a path to also write the timings in the Prometheus text format
+instrumentation_prometheus_path = None
+
+# The resources loaded in this process, name -> (signature, value)
+_resources = {}
+
+
+def file_signature(paths: list) -> tuple:
+    """
+    Calculates the signature of source files, used to know if a cached resource is outdated.
+
+    Args:
+        paths (list): The paths of the source files or folders, the files of a folder are all included.
+
+    Returns:
+        tuple: The path, size and modification time of every source file.
+    """
+    signature = []
+    for path in paths:
+        if os.path.isdir(path):
+            file_paths = sorted(
+                os.path.join(path, filename) for filename in os.listdir(path)
+            )
+        else:
+            file_paths = [path]
+        for file_path in file_paths:
+            stat = os.stat(file_path)
+            signature.append((file_path, stat.st_size, stat.st_mtime_ns))
+    return tuple(signature)
+
+
+def load_resource(name: str, paths: list, loader, persist: bool = True):
+    """
+    Loads a resource at most once per process and keeps a pickled copy on disk.
+
+    The resource is loaded again when the signature of its source files changes.
+    Every call returns the same object (lists, dicts, ...), which must not be modified:
+    copy it before changing it, the changes would be seen by every later call of the process.
+    It is not frozen, as the resources are pickled for the worker processes and given to
+    libraries expecting lists and dicts.
+
+    Args:
+        name (str): The name of the resource, also the name of its cache file.
+        paths (list): The source files or folders of the resource.
+        loader (callable): The function building the resource from its source files.
+        persist (bool, optional): Whether to keep the pickled copy in resource_cache_folder.
+
+    Returns:
+        The value returned by the loader, shared by every caller and read-only.
+    """
+    signature = file_signature(paths)
+    cached = _resources.get(name)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    cache_path = os.path.join(resource_cache_folder, f"{name}.pkl")
+    value = None
+    if persist and os.path.exists(cache_path):
+        with open(cache_path, "rb") as file:
+            cache_signature, cache_value = pickle.load(file)
+        if cache_signature == signature:
+            value = cache_value
+    if value is None:
+        value = loader()
+        if persist:
+            os.makedirs(resource_cache_folder, exist_ok=True)
+            # Write to a temporary file first, other processes may read the cache
+            temp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(temp_path, "wb") as file:
+                pickle.dump((signature, value), file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, cache_path)
+    _resources[name] = (signature, value)
+    return value
 
 
 def txt2list(folder_path: str) -> list:
@@ -45,12 +153,14 @@ def get_stop_word() -> list:
     Get stop words from a file.
 
     Returns:
-        list: List of stop words.
+        list: List of stop words, read-only (see load_resource).
     """
 
-    with open("data/stop_words.txt", "r") as file:
-        stop_words = [word.strip() for word in file.readlines()]
-    return stop_words
+    def loader():
+        with open("data/stop_words.txt", "r") as file:
+            return [word.strip() for word in file.readlines()]
+
+    return load_resource("stop_words", ["data/stop_words.txt"], loader)
 
 
 def get_field_map() -> dict:
@@ -58,12 +168,14 @@ def get_field_map() -> dict:
     Get a dictionary mapping fields from a JSON file.
 
     Returns:
-        dict: Dictionary mapping fields.
+        dict: Dictionary mapping fields, read-only (see load_resource).
     """
 
-    with open("data/field_map.json", "r") as f:
-        field_dict = json.load(f)
-    return field_dict
+    def loader():
+        with open("data/field_map.json", "r") as f:
+            return json.load(f)
+
+    return load_resource("field_map", ["data/field_map.json"], loader, persist=False)
 
 
 def get_sentiment_dict() -> dict:
@@ -71,11 +183,13 @@ def get_sentiment_dict() -> dict:
     Get a sentiment dictionary from a JSON file.
 
     Returns:
-        dict: Sentiment dictionary.
+        dict: Sentiment dictionary, read-only (see load_resource).
     """
-    with open("data/sentiment_dict.json", "r") as file:
-        sentiment_dict = json.load(file)
-    return sentiment_dict
+    def loader():
+        with open("data/sentiment_dict.json", "r") as file:
+            return json.load(file)
+
+    return load_resource("sentiment_dict", ["data/sentiment_dict.json"], loader)
 
 
 def get_medical_list() -> list:
@@ -83,10 +197,14 @@ def get_medical_list() -> list:
     Get a list of medical words from a text file.
 
     Returns:
-        list: List of medical words.
+        list: List of medical words, read-only (see load_resource).
     """
 
-    return txt2list("chinese_medical_words")
+    return load_resource(
+        "medical_list",
+        [medical_words_folder],
+        lambda: txt2list(medical_words_folder),
+    )
 
 
 def get_real_pos() -> dict:
@@ -95,34 +213,42 @@ def get_real_pos() -> dict:
     and returns a dictionary mapping English words to their "isreal" values.
 
     Returns:
-        dict: A dictionary mapping English words to their "isreal" values.
+        dict: A dictionary mapping English words to their "isreal" values,
+            read-only (see load_resource).
     """
 
-    real_df = pd.read_csv("data/pos.csv")
-    return dict(zip(real_df["en"], real_df["isreal"]))
+    def loader():
+        real_df = pd.read_csv("data/pos.csv")
+        return dict(zip(real_df["en"], real_df["isreal"]))
+
+    return load_resource("real_pos", ["data/pos.csv"], loader)
 
 
 def get_word_dict() -> dict:
     """
     Retrieves the word dictionary from the specified file.
     Returns:
-        dict: The word dictionary loaded from the file.
+        dict: The word dictionary loaded from the file, read-only (see load_resource).
     """
 
-    with open("data/word_dict.json", "r") as f:
-        wordDictionary = json.load(f)
-    return wordDictionary
+    def loader():
+        with open("data/word_dict.json", "r") as f:
+            return json.load(f)
+
+    return load_resource("word_dict", ["data/word_dict.json"], loader)
 
 
 def get_rare_list() -> list:
     """
     Reads a file containing rare words and returns a list of those words.
     Returns:
-        list: A list of rare words.
+        list: A list of rare words, read-only (see load_resource).
     """
-    with open("data/rare_words.txt", "r", encoding="utf-8") as file:
-        rare_word = file.read()
-    return list(rare_word)
+    def loader():
+        with open("data/rare_words.txt", "r", encoding="utf-8") as file:
+            return list(file.read())
+
+    return load_resource("rare_list", ["data/rare_words.txt"], loader)
 
 
 if __name__ == "__main__":
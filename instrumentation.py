@@ -0,0 +1,217 @@
+'''
+it is a file that contains the timings of the metric functions, the pipeline stages and the mongo reads and writes.
+Notes:
+1. a timing is named "<kind>.<name>": "metric.count_fog", "stage.segment", "mongo.read.articles", "mongo.write.indexs", ... the report sums the kinds so the mongo time can be compared to the compute time.
+2. the count and the total time are exact, the p50/p99 latencies are calculated from at most SAMPLE_LIMIT samples per timing (reservoir sampling).
+3. the worker processes of calculate_all send their timings back with their results, they are merged into the timings of the main process.
+'''
+
+
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+
+SAMPLE_LIMIT = 10000
+
+# name -> {"count": int, "total": float, "max": float, "samples": list}
+_timings = {}
+_lock = threading.Lock()
+
+
+def record(name: str, seconds: float) -> None:
+    """
+    Adds a measured duration to a timing.
+
+    Args:
+        name (str): The name of the timing, like "metric.count_fog".
+        seconds (float): The duration.
+    """
+    with _lock:
+        timing = _timings.setdefault(
+            name, {"count": 0, "total": 0.0, "max": 0.0, "samples": []}
+        )
+        timing["count"] += 1
+        timing["total"] += seconds
+        timing["max"] = max(timing["max"], seconds)
+        _add_sample(timing, seconds)
+
+
+def _add_sample(timing: dict, seconds: float) -> None:
+    """
+    Keeps a uniform sample of at most SAMPLE_LIMIT durations of a timing.
+    """
+    samples = timing["samples"]
+    if len(samples) < SAMPLE_LIMIT:
+        samples.append(seconds)
+    else:
+        position = random.randrange(timing["count"])
+        if position < SAMPLE_LIMIT:
+            samples[position] = seconds
+
+
+@contextmanager
+def timed(name: str):
+    """
+    Measures the duration of a block.
+
+    Example:
+        >>> with timed("stage.segment"):
+        ...     segment(articles)
+    """
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start_time)
+
+
+def call(name: str, function, *args, **kwargs):
+    """
+    Calls a function and measures its duration.
+
+    Returns:
+        The result of the function.
+    """
+    start_time = time.perf_counter()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        record(name, time.perf_counter() - start_time)
+
+
+def timed_iter(iterable, name: str):
+    """
+    Yields the items of an iterable and measures the time spent to get each one,
+    e.g. the time spent waiting for the documents of a cursor.
+    """
+    iterator = iter(iterable)
+    while True:
+        start_time = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        record(name, time.perf_counter() - start_time)
+        yield item
+
+
+def collect(reset: bool = True) -> dict:
+    """
+    Returns the timings of this process, used to send the timings of a worker process to the main process.
+
+    Args:
+        reset (bool, optional): Clear the timings after collecting them.
+
+    Returns:
+        dict: The timings, which can be passed to merge.
+    """
+    global _timings
+    with _lock:
+        timings = _timings
+        if reset:
+            _timings = {}
+        else:
+            timings = {
+                name: dict(timing, samples=list(timing["samples"]))
+                for name, timing in timings.items()
+            }
+    return timings
+
+
+def merge(timings: dict) -> None:
+    """
+    Adds the timings collected in another process.
+    """
+    with _lock:
+        for name, other in timings.items():
+            timing = _timings.setdefault(
+                name, {"count": 0, "total": 0.0, "max": 0.0, "samples": []}
+            )
+            for sample in other["samples"]:
+                timing["count"] += 1
+                _add_sample(timing, sample)
+            # The count also includes the calls which were not sampled
+            timing["count"] += other["count"] - len(other["samples"])
+            timing["total"] += other["total"]
+            timing["max"] = max(timing["max"], other["max"])
+
+
+def summary() -> dict:
+    """
+    Calculates the statistics of every timing and the total time of every kind.
+
+    Returns:
+        dict: A dictionary containing the following fields:
+            - timings: For every timing, the number of calls, the total, mean, p50, p99
+              and max durations in seconds.
+            - kinds: The total seconds of every kind ("metric", "stage", "mongo.read", "mongo.write", ...).
+    """
+    timings = {}
+    kinds = {}
+    for name, timing in sorted(collect(reset=False).items()):
+        samples = np.array(timing["samples"] or [0.0])
+        timings[name] = {
+            "count": timing["count"],
+            "total": timing["total"],
+            "mean": timing["total"] / max(timing["count"], 1),
+            "p50": float(np.percentile(samples, 50)),
+            "p99": float(np.percentile(samples, 99)),
+            "max": timing["max"],
+        }
+        # "mongo.read.articles" is of kind "mongo.read", "metric.count_fog" of kind "metric"
+        kind = ".".join(name.split(".")[: 2 if name.startswith("mongo.") else 1])
+        kinds[kind] = kinds.get(kind, 0.0) + timing["total"]
+    return {"timings": timings, "kinds": kinds}
+
+
+def write_report(path: str, prometheus_path: str = None) -> dict:
+    """
+    Writes the summary to a JSON file and optionally to a Prometheus text file.
+
+    Args:
+        path (str): The path of the JSON report.
+        prometheus_path (str, optional): The path of the Prometheus text file, skipped when it is None.
+
+    Returns:
+        dict: The summary.
+    """
+    report = summary()
+    report["created"] = time.time()
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as file:
+        json.dump(report, file, indent=4)
+    if prometheus_path is not None:
+        os.makedirs(os.path.dirname(prometheus_path) or ".", exist_ok=True)
+        with open(prometheus_path, "w") as file:
+            file.write(to_prometheus(report))
+    slowest = sorted(report["timings"].items(), key=lambda item: -item[1]["total"])[:10]
+    for name, timing in slowest:
+        print(
+            f"{name}: {timing['total']:.2f}s in {timing['count']} calls, "
+            f"p50 {timing['p50'] * 1000:.2f}ms, p99 {timing['p99'] * 1000:.2f}ms"
+        )
+    print(f"time by kind: {report['kinds']}, report wrote to {path}")
+    return report
+
+
+def to_prometheus(report: dict) -> str:
+    """
+    Formats a summary as Prometheus summaries, one series per timing.
+    """
+    lines = [
+        "# HELP health_articles_duration_seconds The duration of the metrics, stages and mongo operations.",
+        "# TYPE health_articles_duration_seconds summary",
+    ]
+    for name, timing in report["timings"].items():
+        for quantile in ("p50", "p99"):
+            lines.append(
+                f'health_articles_duration_seconds{{name="{name}",quantile="0.{quantile[1:]}"}} '
+                f"{timing[quantile]}"
+            )
+        lines.append(f'health_articles_duration_seconds_sum{{name="{name}"}} {timing["total"]}')
+        lines.append(f'health_articles_duration_seconds_count{{name="{name}"}} {timing["count"]}')
+    return "\n".join(lines) + "\n"
@@ -1,39 +1,99 @@
-from pymongo import MongoClient
 import calculate_topic
 import global_var
+import instrumentation
 from read_data import write_txt_html_xlsx2db
 import process_mongo
 import calculate_index
+import schema
+import sentiment
+from export_parquet import INDEX_FIELD_TYPES, export_parquet
+from pipeline import Stage, run_pipeline
 
 
 def main():
-    # Establish a connection to MongoDB
-    client = MongoClient(global_var.client_url)
-    database = client[global_var.database_name]
+    # Establish a connection to the database of global_var.client_url
+    database = process_mongo.get_db()
+    _, profiling = schema.bootstrap(database)
     # process_mongo.fix_unicode(database,'demand')
     articles = database["articles"]
     indexs = database["indexs"]
     demands = database["demands"]
-    write_txt_html_xlsx2db(
-        database,
-        "articles",
-        "articles",
-        "demands",
-        global_var.health_articles_folder_path,
-    )
-    process_mongo.delete_incomplete_documents(database, "indexs", ["text"])
-    print("starting write segment")
-    calculate_index.segment(database, "articles")
-    print("starting write topic count")
-    calculate_topic.count_topic_all(articles, indexs)
-    print("topic are successfully wrote")
-    print("starting calculate all the other indexs")
-    calculate_index.calculate_all(articles, indexs, None)
-    print("successfully calculate all the other indexs")
-    process_mongo.map_fields(
-        database, "indexs", global_var.get_field_map(), "indexs_zh"
+
+    def export():
+        export_parquet(
+            database,
+            "indexs",
+            global_var.parquet_export_folder,
+            global_var.get_field_map(),
+            INDEX_FIELD_TYPES,
+        )
+        export_parquet(database, "demands", global_var.parquet_export_folder)
+
+    stages = [
+        Stage(
+            "ingest",
+            lambda: write_txt_html_xlsx2db(
+                database,
+                "articles",
+                "articles",
+                "demands",
+                global_var.health_articles_folder_path,
+                incremental=True,
+            ),
+        ),
+        Stage(
+            "cleanup",
+            # The articles without text can not be segmented, the indexs are kept for the incremental stages
+            lambda: process_mongo.delete_incomplete_documents(database, "articles", ["text"]),
+            ["ingest"],
+        ),
+        Stage(
+            "segment",
+            lambda: calculate_index.segment(articles, incremental=True),
+            ["cleanup"],
+        ),
+        Stage(
+            "sentiment",
+            lambda: sentiment.get_sentiment_list(
+                global_var.get_sentiment_dict(), articles, articles, incremental=True
+            ),
+            ["segment"],
+        ),
+        # The topics only need the text, they are counted while the other indexs are calculated
+        Stage("topic", lambda: calculate_topic.count_topic_all(articles, indexs), ["cleanup"]),
+        Stage(
+            "index",
+            lambda: calculate_index.calculate_all(
+                articles, indexs, None, workers=global_var.index_workers, incremental=True
+            ),
+            ["sentiment"],
+        ),
+        Stage(
+            "map",
+            lambda: process_mongo.map_fields(
+                database, "indexs", global_var.get_field_map(), "indexs_zh"
+            ),
+            ["index", "topic"],
+        ),
+        Stage(
+            "merge",
+            lambda: process_mongo.merge(
+                database, "demands", "indexs_zh", "title", "title", "merge"
+            ),
+            ["map"],
+        ),
+        Stage("export", export, ["index", "topic"]),
+    ]
+    try:
+        run_pipeline(database, stages, workers=global_var.pipeline_workers)
+    finally:
+        if profiling is not None:
+            schema.report_slow_queries(database)
+            schema.restore_profiling(database, profiling)
+    instrumentation.write_report(
+        global_var.instrumentation_report_path,
+        global_var.instrumentation_prometheus_path,
     )
-    process_mongo.merge(database, "demands", "indexs_zh", "title", "title", "merge")
 
 
 if __name__ == "__main__":
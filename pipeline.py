@@ -0,0 +1,188 @@
+'''
+it is a file that contains the runner of the stages of the pipeline.
+Notes:
+1. every stage declares the stages it depends on, a stage is started as soon as its dependencies are complete, so independent stages (e.g. the topics and the lexical indexs) run at the same time in threads.
+2. the state of every stage of a run is kept in the metadata collection (global_var.metadata_collection_name). When a run fails, the next run resumes it: the completed stages are skipped and the others start again.
+3. the stages are incremental (ingest manifest, content_hash, missing topics, ...), so a restarted stage continues from the last written batch instead of from the beginning.
+'''
+
+
+import time
+import traceback
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pymongo.database import Database
+import global_var
+import instrumentation
+
+
+class Stage:
+    """
+    A step of the pipeline.
+
+    Example:
+        >>> Stage("segment", lambda: calculate_index.segment(articles), ["ingest"])
+    """
+
+    def __init__(self, name: str, function, depends: list = None) -> None:
+        """
+        Args:
+            name (str): The name of the stage, unique in the pipeline.
+            function (callable): Called without arguments to run the stage.
+            depends (list, optional): The names of the stages which must be complete first.
+        """
+        self.name = name
+        self.function = function
+        self.depends = list(depends or [])
+
+
+def check_stages(stages: list) -> None:
+    """
+    Checks that the names are unique, the dependencies exist and there is no cycle.
+
+    Raises:
+        ValueError: If the stages do not form a DAG.
+    """
+    names = [stage.name for stage in stages]
+    if len(names) != len(set(names)):
+        raise ValueError(f"duplicate stage names: {names}")
+    depends = {stage.name: stage.depends for stage in stages}
+    for name, stage_depends in depends.items():
+        missing = set(stage_depends) - set(names)
+        if missing:
+            raise ValueError(f"stage {name} depends on unknown stages {sorted(missing)}")
+    done = set()
+    while len(done) < len(names):
+        ready = {name for name in names if name not in done and set(depends[name]) <= done}
+        if not ready:
+            raise ValueError(f"cycle between stages {sorted(set(names) - done)}")
+        done |= ready
+
+
+def run_pipeline(
+    database: Database,
+    stages: list,
+    name: str = "main",
+    workers: int = 2,
+    resume: bool = True,
+) -> dict:
+    """
+    Runs the stages in the order of their dependencies, independent stages run concurrently.
+
+    Args:
+        database (Database): The MongoDB database holding the metadata collection.
+        stages (list): The Stage objects of the pipeline.
+        name (str, optional): The name of the pipeline, its runs are recorded under it.
+        workers (int, optional): The number of stages running at the same time.
+        resume (bool, optional): Resume the last run if it did not complete,
+            otherwise every stage runs again.
+
+    Returns:
+        dict: A dictionary mapping each stage to its elapsed seconds, None for the skipped stages.
+
+    Raises:
+        RuntimeError: If a stage fails, the stages already running are completed first.
+    """
+    check_stages(stages)
+    metadata = database[global_var.metadata_collection_name]
+    run_id = _start_run(metadata, name, resume)
+    completed = {
+        record["stage"]
+        for record in metadata.find(
+            {"pipeline": name, "run_id": run_id, "status": "complete"}, {"stage": 1}
+        )
+    }
+    elapsed = {stage_name: None for stage_name in completed}
+    if completed:
+        print(f"resuming run {run_id} of {name}, skipping {sorted(completed)}")
+    pending = {stage.name: stage for stage in stages if stage.name not in completed}
+    failed = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            if not failed:
+                for stage in list(pending.values()):
+                    if set(stage.depends) <= completed:
+                        del pending[stage.name]
+                        running[
+                            executor.submit(_run_stage, metadata, name, run_id, stage)
+                        ] = stage.name
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage_name = running.pop(future)
+                try:
+                    elapsed[stage_name] = future.result()
+                    completed.add(stage_name)
+                except Exception as e:
+                    failed[stage_name] = e
+    if failed:
+        metadata.update_one(
+            {"_id": f"pipeline:{name}"}, {"$set": {"status": "failed"}}
+        )
+        raise RuntimeError(f"stages {sorted(failed)} of run {run_id} failed") from next(
+            iter(failed.values())
+        )
+    metadata.update_one(
+        {"_id": f"pipeline:{name}"},
+        {"$set": {"status": "complete", "finished": time.time()}},
+    )
+    print(f"run {run_id} of {name} complete: {elapsed}")
+    return elapsed
+
+
+def _start_run(metadata, name: str, resume: bool) -> str:
+    """
+    Returns the id of the last run when it has to be resumed, otherwise records a new run.
+    """
+    last_run = metadata.find_one({"_id": f"pipeline:{name}"})
+    if resume and last_run is not None and last_run.get("status") != "complete":
+        return last_run["run_id"]
+    run_id = uuid.uuid4().hex
+    metadata.update_one(
+        {"_id": f"pipeline:{name}"},
+        {"$set": {"run_id": run_id, "status": "running", "started": time.time()}},
+        upsert=True,
+    )
+    return run_id
+
+
+def _run_stage(metadata, name: str, run_id: str, stage: Stage) -> float:
+    """
+    Runs a stage and records its state, returns its elapsed seconds.
+    """
+    stage_filter = {"_id": f"stage:{name}:{stage.name}"}
+    metadata.update_one(
+        stage_filter,
+        {
+            "$set": {
+                "pipeline": name,
+                "stage": stage.name,
+                "run_id": run_id,
+                "status": "running",
+                "started": time.time(),
+            },
+            "$unset": {"error": ""},
+        },
+        upsert=True,
+    )
+    print(f"starting stage {stage.name}")
+    start_time = time.monotonic()
+    try:
+        stage.function()
+    except Exception:
+        metadata.update_one(
+            stage_filter,
+            {"$set": {"status": "failed", "error": traceback.format_exc()}},
+        )
+        print(f"stage {stage.name} failed:\n{traceback.format_exc()}")
+        raise
+    elapsed = time.monotonic() - start_time
+    instrumentation.record(f"stage.{stage.name}", elapsed)
+    metadata.update_one(
+        stage_filter,
+        {"$set": {"status": "complete", "finished": time.time(), "elapsed": elapsed}},
+    )
+    print(f"stage {stage.name} complete in {elapsed:.1f}s")
+    return elapsed
@@ -1,6 +1,282 @@
-import pandas as pd
+import time
+import numpy as np
+from bson.binary import Binary
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.collection import Collection
 from pymongo.database import Database
 from tqdm import tqdm
+import global_var
+import instrumentation
+import schema
+import storage
+
+
+def get_db() -> Database:
+    """
+    Connects to the database configured in global_var, see storage.get_database for the supported urls.
+
+    Returns:
+        Database: The database named global_var.database_name.
+    """
+    return storage.get_database(global_var.client_url, global_var.database_name)
+
+
+class BulkWriter:
+    """
+    Buffers write operations for a collection and sends them with bulk_write(ordered=False)
+    every batch_size operations or every flush_interval seconds, so the memory does not grow
+    with the corpus and a crash only loses the last unflushed batch.
+
+    Example:
+        >>> with BulkWriter(database["indexs"]) as writer:
+        ...     writer.upsert({"title": "title"}, {"completely": True})
+        >>> writer.summary()
+        {'written': 1, 'matched': 0, 'modified': 0, 'upserted': 1, 'inserted': 0, 'batches': 1, 'elapsed': 0.004, 'docs_per_sec': 250.0}
+    """
+
+    def __init__(
+        self,
+        collection: Collection,
+        batch_size: int = global_var.BULK_BATCH_SIZE,
+        flush_interval: float = global_var.BULK_FLUSH_INTERVAL,
+        before_flush=None,
+    ) -> None:
+        """
+        Args:
+            collection (Collection): The collection to write to.
+            batch_size (int, optional): Flush when this many operations are buffered.
+            flush_interval (float, optional): Flush when the oldest buffered operation is older
+                than this many seconds.
+            before_flush (callable, optional): Called without arguments before the buffered
+                operations are sent, e.g. to write first the documents they refer to.
+        """
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.before_flush = before_flush
+        self.operations = []
+        self.start_time = time.monotonic()
+        self.last_flush = self.start_time
+        self.counts = {
+            "written": 0,
+            "matched": 0,
+            "modified": 0,
+            "upserted": 0,
+            "inserted": 0,
+            "batches": 0,
+        }
+
+    def add(self, operation) -> None:
+        """
+        Buffers a pymongo write operation (UpdateOne, InsertOne, ...) and flushes if needed.
+        """
+        self.operations.append(operation)
+        if (
+            len(self.operations) >= self.batch_size
+            or time.monotonic() - self.last_flush >= self.flush_interval
+        ):
+            self.flush()
+
+    def upsert(self, key_filter: dict, fields: dict) -> None:
+        """
+        Buffers an UpdateOne that sets the fields of the document matching key_filter.
+        """
+        self.add(UpdateOne(key_filter, {"$set": fields}, upsert=True))
+
+    def flush(self) -> None:
+        """
+        Sends the buffered operations to the collection.
+        """
+        self.last_flush = time.monotonic()
+        if not self.operations:
+            return
+        if self.before_flush is not None:
+            self.before_flush()
+        operations, self.operations = self.operations, []
+        result = instrumentation.call(
+            f"mongo.write.{self.collection.name}",
+            self.collection.bulk_write,
+            operations,
+            ordered=False,
+        )
+        self.counts["written"] += len(operations)
+        self.counts["matched"] += result.matched_count
+        self.counts["modified"] += result.modified_count
+        self.counts["upserted"] += result.upserted_count
+        self.counts["inserted"] += result.inserted_count
+        self.counts["batches"] += 1
+
+    def summary(self) -> dict:
+        """
+        Returns the number of written, matched, modified, upserted and inserted documents,
+        the seconds since the writer was created and the written documents per second,
+        calculated from the rounded seconds so both agree (0.0 when they round to 0).
+        """
+        summary = dict(self.counts)
+        summary["elapsed"] = round(time.monotonic() - self.start_time, 3)
+        summary["docs_per_sec"] = (
+            round(self.counts["written"] / summary["elapsed"], 1)
+            if summary["elapsed"] > 0
+            else 0.0
+        )
+        return summary
+
+    def __enter__(self) -> "BulkWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback) -> None:
+        # Flush what has been calculated even if the loop failed
+        self.flush()
+
+
+def batched(records, batch_size: int):
+    """
+    Groups a cursor into lists of at most batch_size records.
+
+    Args:
+        records: The records, e.g. a cursor.
+        batch_size (int): The maximum number of records of a list.
+
+    Yields:
+        list: The next records.
+    """
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def pack_array(array: np.ndarray) -> dict:
+    """
+    Packs a NumPy array into a compact document field.
+
+    Args:
+        array (np.ndarray): The array to pack.
+
+    Returns:
+        dict: A dictionary containing the dtype, the shape and the little-endian bytes of the array.
+    """
+    array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder("<"))
+    return {
+        "dtype": array.dtype.str,
+        "shape": list(array.shape),
+        "data": Binary(array.tobytes()),
+    }
+
+
+def unpack_array(packed: dict) -> np.ndarray:
+    """
+    Unpacks a document field written by pack_array.
+
+    Args:
+        packed (dict): The packed array.
+
+    Returns:
+        np.ndarray: The array, read-only since it shares the memory of the field.
+    """
+    return np.frombuffer(packed["data"], dtype=packed["dtype"]).reshape(packed["shape"])
+
+
+def stream_transform(
+    database: Database,
+    collection_name: str,
+    transform,
+    filter_query: dict = None,
+    projection: dict = None,
+    output_name: str = None,
+    batch_size: int = global_var.BULK_BATCH_SIZE,
+    checkpoint: str = None,
+) -> dict:
+    """
+    Streams the documents of a collection through a function and bulk writes the operations it returns.
+
+    The documents are read in _id order. When a checkpoint name is given, the last _id of each
+    written batch is saved in the metadata collection, so an interrupted pass starts again after
+    it. The checkpoint is removed when the pass is complete.
+
+    Example:
+        >>> stream_transform(
+        ...     database, "demands",
+        ...     lambda record: UpdateOne({"_id": record["_id"]}, {"$set": {"checked": True}}),
+        ...     projection={"_id": 1},
+        ... )
+        {'read': 10, 'skipped': 0, 'written': 10, ...}
+
+    Args:
+        database (Database): The MongoDB database.
+        collection_name (str): The name of the collection to read.
+        transform (callable): Receives a document and returns a pymongo write operation,
+            a list of operations, or None to skip the document.
+        filter_query (dict, optional): Only the matching documents are read.
+        projection (dict, optional): Only the fields used by transform need to be read.
+        output_name (str, optional): The collection to write to. Defaults to collection_name.
+        batch_size (int, optional): The number of documents read and written at once.
+        checkpoint (str, optional): The name of the checkpoint of the pass, None to always start from the beginning.
+
+    Returns:
+        dict: The number of read and skipped documents and the BulkWriter summary.
+    """
+    metadata = database[global_var.metadata_collection_name]
+    checkpoint_id = None if checkpoint is None else f"stream_transform:{checkpoint}"
+    query = dict(filter_query or {})
+    if checkpoint_id is not None:
+        saved = metadata.find_one({"_id": checkpoint_id})
+        if saved is not None:
+            print(f"resuming {checkpoint} after _id {saved['last_id']}")
+            query = {"$and": [query, {"_id": {"$gt": saved["last_id"]}}]}
+    cursor = (
+        database[collection_name]
+        .find(query, projection)
+        .sort("_id", 1)
+        .batch_size(batch_size)
+    )
+    stats = {"read": 0, "skipped": 0}
+    # The batches are flushed here, after each one the checkpoint is saved
+    writer = BulkWriter(
+        database[output_name or collection_name], float("inf"), float("inf")
+    )
+    last_id = None
+    with tqdm(desc=f"Processing {collection_name}") as pbar:
+        for document in cursor:
+            operations = transform(document)
+            stats["read"] += 1
+            if operations is None:
+                stats["skipped"] += 1
+            elif isinstance(operations, list):
+                for operation in operations:
+                    writer.add(operation)
+            else:
+                writer.add(operations)
+            last_id = document["_id"]
+            if stats["read"] % batch_size == 0:
+                _flush_checkpoint(writer, metadata, checkpoint_id, last_id)
+                pbar.update(batch_size)
+        _flush_checkpoint(writer, metadata, checkpoint_id, last_id)
+        pbar.update(stats["read"] % batch_size)
+    if checkpoint_id is not None:
+        metadata.delete_one({"_id": checkpoint_id})
+    stats.update(writer.summary())
+    print(f"{collection_name} processed: {stats}")
+    return stats
+
+
+def _flush_checkpoint(
+    writer: BulkWriter, metadata: Collection, checkpoint_id: str, last_id
+) -> None:
+    """
+    Flushes the writer, then saves the _id of the last document of the batch as the checkpoint.
+    """
+    writer.flush()
+    if checkpoint_id is not None and last_id is not None:
+        metadata.update_one(
+            {"_id": checkpoint_id},
+            {"$set": {"last_id": last_id, "updated": time.time()}},
+            upsert=True,
+        )
 
 
 def copy_a2b(
@@ -19,22 +295,19 @@ def copy_a2b(
         field (str, optional): The field to update or insert. Defaults to "data_availability".
         key (str, optional): The key to locate the document. Defaults to "title".
     """
-    total_documents = database[collection_read_name].count_documents({})
-    with tqdm(total=total_documents, desc="Processing documents") as pbar:
-        for result in database[collection_read_name].find():
-            if field in result.keys():
-                database[collection_wrote_name].update_one(
-                    {key: result[key]},  # Locate the document based on the key
-                    {
-                        "$set": {field: result[field]}
-                    },  # Update or insert the field and value
-                    upsert=True,
-                )
-            else:
-                tqdm.write(
-                    f"Field '{field}' not found in document with {key} = {result.get(key)}"
-                )
-            pbar.update(1)
+    stream_transform(
+        database,
+        collection_read_name,
+        lambda result: UpdateOne(
+            {key: result[key]},  # Locate the document based on the key
+            {"$set": {field: result[field]}},  # Update or insert the field and value
+            upsert=True,
+        ),
+        filter_query={field: {"$exists": True}, key: {"$exists": True}},
+        projection={key: 1, field: 1},
+        output_name=collection_wrote_name,
+        checkpoint=f"copy_a2b:{collection_read_name}:{collection_wrote_name}:{field}",
+    )
 
 
 def delete_empty_text(
@@ -51,34 +324,77 @@ def delete_empty_text(
 
 
 def map_fields(
-    database: Database, table_name: str, field_mapping: dict, output_name: str = "merge"
+    database: Database,
+    table_name: str,
+    field_mapping: dict,
+    output_name: str = "merge",
+    key: str = "title",
+    method: str = None,
 ) -> None:
     """
     Maps fields from one collection to another based on a field mapping dictionary.
 
+    The mapped documents are upserted on the mapped key, so running it again updates the
+    output collection instead of adding duplicates.
+
     Args:
         db (Database): The MongoDB database.
         table_name (str): The name of the source collection.
         field_mapping (dict): A dictionary mapping old field names to new field names.
+        output_name (str, optional): The name of the output collection. Defaults to "merge".
+        key (str, optional): The field of the source collection identifying a document. Defaults to "title".
+        method (str, optional): "aggregate" runs a $project/$merge pipeline on the server,
+            "batched" upserts the mapped documents with bulk writes. Defaults to "aggregate"
+            on mongo and "batched" on the local databases.
 
     Returns:
-        pymongo.collection.Collection: The new collection where the mapped documents are inserted.
+        None
     """
+    if method is None:
+        method = "aggregate" if storage.is_mongo(database) else "batched"
     collection = database[table_name]
-    total_documents = collection.count_documents({})
-    with tqdm(total=total_documents, desc="Processing documents") as pbar:
-        for document in collection.find():
-            try:
+    output_key = field_mapping.get(key, key)
+    schema.ensure_unique_key(database, output_name, output_key)
+    if method == "aggregate":
+        projection = {"_id": 0, output_key: f"${key}"}
+        projection.update(
+            {new_field: f"${old_field}" for old_field, new_field in field_mapping.items()}
+        )
+        pipeline = [
+            {"$match": {key: {"$exists": True, "$ne": None}}},
+            {"$project": projection},
+            {
+                "$merge": {
+                    "into": output_name,
+                    "on": output_key,
+                    "whenMatched": "replace",
+                    "whenNotMatched": "insert",
+                }
+            },
+        ]
+        collection.aggregate(pipeline, allowDiskUse=True)
+    elif method == "batched":
+        projection = {"_id": 0, key: 1}
+        projection.update({old_field: 1 for old_field in field_mapping})
+        with BulkWriter(database[output_name]) as writer:
+            for document in tqdm(
+                collection.find({key: {"$exists": True, "$ne": None}}, projection),
+                desc="Mapping documents",
+            ):
                 updated_document = {
                     new_field: document[old_field]
                     for old_field, new_field in field_mapping.items()
                     if old_field in document
                 }
-                new_collection = database[f"{output_name}"]
-                new_collection.insert_one(updated_document)
-                pbar.update(1)
-            except Exception as e:
-                tqdm.write(f"An error occurred: {str(e)}")
+                updated_document[output_key] = document[key]
+                writer.add(
+                    ReplaceOne({output_key: document[key]}, updated_document, upsert=True)
+                )
+        print(f"mapped fields were successfully wrote: {writer.summary()}")
+    else:
+        raise ValueError(f"unknown map_fields method: {method}")
+    mapped_count = database[output_name].count_documents({})
+    print(f"Total mapped data: {mapped_count}")
     return None
 
 
@@ -89,10 +405,16 @@ def merge(
     local_field: str,
     foreign_field: str,
     merge_collection_name: str = "merge",
+    method: str = None,
+    chunk_size: int = 1000,
 ) -> None:
     """
     Merge data from two MongoDB collections based on specified fields.
 
+    The merged documents are upserted on local_field, so running it again updates the
+    merge collection instead of adding duplicates. When a field is in both documents,
+    the value of the local document is kept.
+
     Args:
         db (Database): The MongoDB database object.
         local_collection_name (str): The name of the local collection.
@@ -100,18 +422,73 @@ def merge(
         local_field (str): The field in the local collection to merge on.
         foreign_field (str): The field in the foreign collection to merge on.
         merge_collection_name (str, optional): The name of the merge collection. Defaults to "merge".
+        method (str, optional): "aggregate" runs a $lookup/$merge pipeline on the server,
+            "chunked" joins chunk_size foreign documents at a time in this process. Defaults to
+            "aggregate" on mongo and "chunked" on the local databases.
+        chunk_size (int, optional): The number of foreign documents joined at once by "chunked".
 
     Returns:
         None
     """
-    df_local = pd.DataFrame(database[local_collection_name].find())
-    df_foreign = pd.DataFrame(database[foreign_collection_name].find())
-    merged_df = pd.merge(
-        df_local, df_foreign, how="inner", left_on=local_field, right_on=foreign_field
-    )
-    merged_count = len(merged_df)
-    if merged_count > 0:
-        database[merge_collection_name].insert_many(merged_df.to_dict(orient="records"))
+    if method is None:
+        method = "aggregate" if storage.is_mongo(database) else "chunked"
+    merge_collection = database[merge_collection_name]
+    schema.ensure_unique_key(database, merge_collection_name, local_field)
+    if method == "aggregate":
+        pipeline = [
+            {"$match": {local_field: {"$exists": True, "$ne": None}}},
+            {
+                "$lookup": {
+                    "from": foreign_collection_name,
+                    "localField": local_field,
+                    "foreignField": foreign_field,
+                    "as": "_foreign",
+                }
+            },
+            {"$unwind": "$_foreign"},
+            {"$replaceRoot": {"newRoot": {"$mergeObjects": ["$_foreign", "$$ROOT"]}}},
+            {"$project": {"_id": 0, "_foreign": 0}},
+            {
+                "$merge": {
+                    "into": merge_collection_name,
+                    "on": local_field,
+                    "whenMatched": "replace",
+                    "whenNotMatched": "insert",
+                }
+            },
+        ]
+        database[local_collection_name].aggregate(pipeline, allowDiskUse=True)
+    elif method == "chunked":
+        with BulkWriter(merge_collection) as writer:
+            foreign_records = database[foreign_collection_name].find({}, {"_id": 0})
+            for chunk in batched(foreign_records, chunk_size):
+                # Like the $lookup of "aggregate", the documents without the join field are skipped
+                foreign_dict = {
+                    record[foreign_field]: record
+                    for record in chunk
+                    if record.get(foreign_field) is not None
+                }
+                if not foreign_dict:
+                    continue
+                for local_record in database[local_collection_name].find(
+                    {local_field: {"$in": list(foreign_dict)}}, {"_id": 0}
+                ):
+                    foreign_record = foreign_dict.get(local_record.get(local_field))
+                    if foreign_record is None:
+                        continue
+                    merged_record = dict(foreign_record)
+                    merged_record.update(local_record)
+                    writer.add(
+                        ReplaceOne(
+                            {local_field: merged_record[local_field]},
+                            merged_record,
+                            upsert=True,
+                        )
+                    )
+        print(f"merge were successfully wrote: {writer.summary()}")
+    else:
+        raise ValueError(f"unknown merge method: {method}")
+    merged_count = merge_collection.count_documents({})
     print(f"Total merged data: {merged_count}")
 
 
@@ -215,6 +592,8 @@ def fix_unicode(database: Database, collection_name: str) -> None:
     """
     Fix unicode characters in the 'author' field of documents in a MongoDB collection.
 
+    Only the authors still encoded like "1_#U5F20#U4E09" are read, so it can be run again.
+
     Args:
         database: MongoDB database object.
         collection_name: Name of the collection to process.
@@ -222,11 +601,13 @@ def fix_unicode(database: Database, collection_name: str) -> None:
     Returns:
         None
     """
-    total_documents = database[collection_name].count_documents({})
-    with tqdm(total=total_documents, desc="Processing documents") as pbar:
-        for record in database[collection_name].find({}, {"author": 1}):
-            record.update(unicode2chr(record["author"]))
-            database[collection_name].update_one(
-                {"_id": record["_id"]}, {"$set": record}, upsert=True
-            )
-            pbar.update(1)
+    stream_transform(
+        database,
+        collection_name,
+        lambda record: UpdateOne(
+            {"_id": record["_id"]}, {"$set": unicode2chr(record["author"])}
+        ),
+        filter_query={"author": {"$regex": r"^\d+_"}},
+        projection={"author": 1},
+        checkpoint=f"fix_unicode:{collection_name}",
+    )
@@ -1,13 +1,23 @@
+import hashlib
+import io
 import os
 import re
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
 import pymongo.collection
 import pymongo.database
-from process_mongo import get_db
+import global_var
+from process_mongo import BulkWriter, get_db
 import pymongo
 from tqdm import tqdm
 
+# The kind of the manifest documents in the metadata collection
+MANIFEST_KIND = "ingest_manifest"
+# The title of an article in the name of its text and html files
+TITLE_PATTERN = re.compile(r"(?:html|text)_(?:\d+\.)?(.*?)\.(?:txt|html)")
+
 
 def write_txt_html_xlsx2db(
     database: pymongo.database.Database,
@@ -15,26 +25,271 @@ def write_txt_html_xlsx2db(
     html_collection_name: str,
     xlsx_collection_name: str,
     parent_folder: str,
+    incremental: bool = False,
 ) -> None:
     """
     Writes files from the specified parent folder to the database.
+    The files are read by a thread pool and upserted with batched bulk writes.
 
     Args:
         parent_folder (str): The path of the parent folder containing the files.
+        incremental (bool, optional): Only write the files that are new or changed since
+            they were last written to this database, according to the ingestion manifest
+            kept in its metadata collection, and the text and html files of the articles
+            missing from it (e.g. deleted by the cleanup stage).
+
+    Returns:
+        None
+    """
+    start_time = time.monotonic()
+    folders = scan_folder(parent_folder)
+    known_hashes = {}
+    if incremental:
+        present_titles = {
+            header: load_titles(database[name], header)
+            for header, name in (("text", txt_collection_name), ("html", html_collection_name))
+        }
+        stats = {
+            os.path.join(folder_path, file_name): stat
+            for folder_path, file_names in folders.items()
+            for kind_stats in file_names.values()
+            for file_name, stat in kind_stats.items()
+        }
+        folders, known_hashes = filter_changed_files(
+            folders, load_manifest(database), present_titles
+        )
+    failed_paths = set()
+    file_hashes = {}
+    writers = {
+        name: BulkWriter(database[name])
+        for name in {txt_collection_name, html_collection_name, xlsx_collection_name}
+    }
+    document_count = 0
+    with ThreadPoolExecutor(max_workers=global_var.ingest_workers) as executor:
+        for folder_path, file_names in tqdm(folders.items()):
+            for header, name in (
+                ("text", txt_collection_name),
+                ("html", html_collection_name),
+            ):
+                document_count += files2db(
+                    folder_path,
+                    header,
+                    database[name],
+                    writers[name],
+                    executor,
+                    file_names[header],
+                    failed_paths,
+                    known_hashes,
+                    file_hashes,
+                )
+            document_count += xlsx2db(
+                folder_path,
+                database[xlsx_collection_name],
+                writers[xlsx_collection_name],
+                file_names["xlsx"],
+                known_hashes,
+                file_hashes,
+            )
+    for name, writer in writers.items():
+        writer.flush()
+        print(f"{name} were successfully wrote: {writer.summary()}")
+    if incremental:
+        # Only record the files once they are written, the failed files are read again next time
+        save_manifest(
+            database,
+            {
+                file_path: {
+                    "mtime": stats[file_path].st_mtime_ns,
+                    "size": stats[file_path].st_size,
+                    "hash": file_hash,
+                }
+                for file_path, file_hash in file_hashes.items()
+                if file_path not in failed_paths
+            },
+        )
+    # The rate is calculated from the rounded seconds like BulkWriter.summary
+    elapsed = round(time.monotonic() - start_time, 1)
+    docs_per_sec = document_count / elapsed if elapsed > 0 else 0.0
+    print(f"{document_count} documents in {elapsed:.1f}s ({docs_per_sec:.1f} docs/sec)")
+
+
+def scan_folder(parent_folder: str) -> dict:
+    """
+    Lists every author folder of the parent folder once and groups its files by kind.
+
+    Args:
+        parent_folder (str): The path of the parent folder containing the author folders.
+
+    Returns:
+        dict: A dictionary mapping each author folder path to a dictionary with the keys
+            'text', 'html' and 'xlsx', each one mapping a file name to its os.stat_result.
+    """
+    folders = {}
+    for folder_entry in os.scandir(parent_folder):
+        if not folder_entry.is_dir():
+            continue
+        file_names = {"text": {}, "html": {}, "xlsx": {}}
+        for entry in os.scandir(folder_entry.path):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(".xlsx"):
+                file_names["xlsx"][entry.name] = entry.stat()
+            elif entry.name.endswith(".txt"):
+                for header in ("text", "html"):
+                    if entry.name.startswith(header):
+                        file_names[header][entry.name] = entry.stat()
+        folders[folder_entry.path] = file_names
+    return folders
+
+
+def filter_changed_files(
+    folders: dict, manifest: dict, present_titles: dict = None
+) -> tuple[dict, dict]:
+    """
+    Keeps only the files that are not recorded in the manifest or may have changed.
+
+    A file whose size and modification time are unchanged is skipped without reading it,
+    unless the title of a text or html file is missing from present_titles, e.g. because
+    the cleanup stage deleted an article whose html was written before its text.
+    The other files are read only once, by the ingestion, which hashes them while reading:
+    a file whose hash is the recorded one is not written again.
+
+    Args:
+        folders (dict): The folders returned by scan_folder.
+        manifest (dict): The manifest returned by load_manifest.
+        present_titles (dict, optional): A dictionary mapping 'text' and 'html' to the
+            titles having that field in the database, see load_titles.
+
+    Returns:
+        tuple[dict, dict]: The files to read, grouped like scan_folder, and the recorded
+            hash of the files whose size or modification time changed.
+    """
+    present_titles = present_titles or {}
+    changed_folders = {}
+    known_hashes = {}
+    for folder_path, file_names in folders.items():
+        changed_file_names = {kind: {} for kind in file_names}
+        for kind, stats in file_names.items():
+            for file_name, stat in stats.items():
+                file_path = os.path.join(folder_path, file_name)
+                entry = manifest.get(file_path)
+                title = TITLE_PATTERN.search(file_name) if kind in present_titles else None
+                if title is not None and title[1] not in present_titles[kind]:
+                    entry = None
+                if entry is not None:
+                    if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+                        continue
+                    known_hashes[file_path] = entry["hash"]
+                changed_file_names[kind][file_name] = stat
+        if any(changed_file_names.values()):
+            changed_folders[folder_path] = changed_file_names
+    return changed_folders, known_hashes
+
+
+def load_titles(collection: pymongo.collection.Collection, field: str) -> set:
+    """
+    Returns the titles of the documents of a collection which have a field.
+    """
+    records = collection.find({field: {"$exists": True}}, {"_id": 0, "title": 1})
+    return {record["title"] for record in records}
+
+
+def load_manifest(database: pymongo.database.Database) -> dict:
+    """
+    Loads the ingestion manifest of a database, mapping each ingested file path to its mtime, size and hash.
+
+    The manifest is kept in the metadata collection of the database it describes, so a new
+    or emptied database has an empty manifest and every file is written to it.
+
+    Args:
+        database (pymongo.database.Database): The database the files are written to.
+
+    Returns:
+        dict: The manifest, empty if no file was written to the database.
+    """
+    records = database[global_var.metadata_collection_name].find(
+        {"kind": MANIFEST_KIND}, {"_id": 0, "path": 1, "mtime": 1, "size": 1, "hash": 1}
+    )
+    return {
+        record["path"]: {
+            "mtime": record["mtime"],
+            "size": record["size"],
+            "hash": record["hash"],
+        }
+        for record in records
+    }
+
+
+def save_manifest(database: pymongo.database.Database, manifest_updates: dict) -> None:
+    """
+    Records the written files in the ingestion manifest of a database.
+
+    Args:
+        database (pymongo.database.Database): The database the files were written to.
+        manifest_updates (dict): A dictionary mapping each written file path to its
+            mtime, size and hash.
 
     Returns:
         None
     """
-    for folder_name in tqdm(os.listdir(parent_folder)):
-        folder_path = os.path.join(parent_folder, folder_name)
-        files2db(folder_path, "text", database[txt_collection_name])
-        files2db(folder_path, "html", database[html_collection_name])
-        xlsx2db(folder_path, database[xlsx_collection_name])
+    with BulkWriter(database[global_var.metadata_collection_name]) as writer:
+        for file_path, entry in manifest_updates.items():
+            writer.upsert(
+                {"_id": f"{MANIFEST_KIND}:{file_path}"},
+                dict(entry, kind=MANIFEST_KIND, path=file_path),
+            )
+
+
+def _read_file(file_path: str) -> tuple[str, str]:
+    """
+    Reads the content of a file and calculates its sha1 from the same read.
+    """
+    with open(file_path, "rb") as file:
+        data = file.read()
+    # Decoded like open(file_path, "r")
+    return io.TextIOWrapper(io.BytesIO(data)).read(), hashlib.sha1(data).hexdigest()
+
+
+def _read_files(file_paths: list, executor: ThreadPoolExecutor = None):
+    """
+    Reads files, yielding each path with its content, or with the exception raised while
+    reading it, so one unreadable file does not stop the others.
+
+    Args:
+        file_paths (list): The paths of the files.
+        executor (ThreadPoolExecutor, optional): The thread pool reading the files, the
+            files are yielded as they are read. The files are read one by one when it is None.
+
+    Yields:
+        tuple: The path, the content and sha1 returned by _read_file (None on error)
+            and the exception (None on success).
+    """
+    if executor is None:
+        for file_path in file_paths:
+            try:
+                yield file_path, _read_file(file_path), None
+            except Exception as error:
+                yield file_path, None, error
+        return
+    futures = {executor.submit(_read_file, file_path): file_path for file_path in file_paths}
+    for future in as_completed(futures):
+        try:
+            yield futures[future], future.result(), None
+        except Exception as error:
+            yield futures[future], None, error
 
 
 def files2db(
-    folder_path: str, header: str, collection: pymongo.collection.Collection
-) -> None:
+    folder_path: str,
+    header: str,
+    collection: pymongo.collection.Collection,
+    writer: BulkWriter = None,
+    executor: ThreadPoolExecutor = None,
+    file_names: list = None,
+    failed_paths: set = None,
+    known_hashes: dict = None,
+    file_hashes: dict = None,
+) -> int:
     """
     Read text files from a folder and insert the content into a MongoDB collection.
 
@@ -42,45 +297,103 @@ def files2db(
         folder_path (str): Path to the folder containing the text files.
         header (str): Header prefix of the text files.
         collection (pymongo.collection.Collection): MongoDB collection to insert the data into.
+        writer (BulkWriter, optional): A writer of the collection shared with other calls,
+            a writer flushed at the end of this call is used when it is None.
+        executor (ThreadPoolExecutor, optional): The thread pool reading the files.
+            The files are read one by one when it is None.
+        file_names (list, optional): The files of the folder to read, every file is read
+            when it is None.
+        failed_paths (set, optional): Collects the paths of the files which could not be written.
+        known_hashes (dict, optional): The recorded hash of some files, a file whose content
+            has this hash is not written again.
+        file_hashes (dict, optional): Collects the hash of each file written or unchanged.
 
     Returns:
-        None
+        int: The number of documents written.
     """
-    title_pattern = re.compile(r"(?:html|text)_(?:\d+\.)?(.*?)\.(?:txt|html)")
+    known_hashes = known_hashes or {}
     folder_name = os.path.basename(folder_path)
     author = folder_name
-    for file_name in os.listdir(folder_path):
-        if file_name.endswith(".txt") and file_name.startswith(header):
-            file_path = os.path.join(folder_path, file_name)
-            with open(file_path, "r") as file:
-                content = file.read()
-                title = title_pattern.search(file_name)[1]
-                record = {header: content, "title": title, "author": str(author)}
-                try:
-                    collection.update_one(
-                        {"title": record["title"]}, {"$set": record}, upsert=True
-                    )
-                except Exception:
-                    print(f"wrong{record}")
-                    print(traceback.print_exc())
+    if file_names is None:
+        file_names = os.listdir(folder_path)
+    file_names = [
+        file_name
+        for file_name in file_names
+        if file_name.endswith(".txt") and file_name.startswith(header)
+    ]
+    file_paths = [os.path.join(folder_path, file_name) for file_name in file_names]
+    own_writer = writer is None
+    if own_writer:
+        writer = BulkWriter(collection)
+    document_count = 0
+    for file_path, result, error in _read_files(file_paths, executor):
+        file_name = os.path.basename(file_path)
+        try:
+            if error is not None:
+                raise error
+            content, file_hash = result
+            if file_hashes is not None:
+                file_hashes[file_path] = file_hash
+            if known_hashes.get(file_path) == file_hash:
+                continue
+            title = TITLE_PATTERN.search(file_name)[1]
+            record = {header: content, "title": title, "author": str(author)}
+            writer.upsert({"title": record["title"]}, record)
+            document_count += 1
+        except Exception:
+            if failed_paths is not None:
+                failed_paths.add(file_path)
+            print(f"wrong{file_name}")
+            print(traceback.print_exc())
+    if own_writer:
+        writer.flush()
+    return document_count
 
 
-def xlsx2db(folder_path: str, collection: pymongo.collection.Collection) -> None:
+def xlsx2db(
+    folder_path: str,
+    collection: pymongo.collection.Collection,
+    writer: BulkWriter = None,
+    file_names: list = None,
+    known_hashes: dict = None,
+    file_hashes: dict = None,
+) -> int:
     """
     Read Excel files from a folder and insert or update the data in a MongoDB collection.
 
     Args:
         folder_path (str): The path to the folder containing the Excel files.
         collection (pymongo.collection.Collection): The MongoDB collection to insert or update the data.
+        writer (BulkWriter, optional): A writer of the collection shared with other calls,
+            a writer flushed at the end of this call is used when it is None.
+        file_names (list, optional): The files of the folder to read, every file is read
+            when it is None.
+        known_hashes (dict, optional): The recorded hash of some files, a file whose content
+            has this hash is not written again.
+        file_hashes (dict, optional): Collects the hash of each file written or unchanged.
 
     Returns:
-        None
+        int: The number of documents written.
     """
-    for file_name in os.listdir(folder_path):
+    known_hashes = known_hashes or {}
+    own_writer = writer is None
+    if own_writer:
+        writer = BulkWriter(collection)
+    if file_names is None:
+        file_names = os.listdir(folder_path)
+    document_count = 0
+    for file_name in file_names:
         if file_name.endswith(".xlsx"):
             file_path = os.path.join(folder_path, file_name)
+            with open(file_path, "rb") as file:
+                data = file.read()
+            file_hash = hashlib.sha1(data).hexdigest()
+            if file_hashes is not None:
+                file_hashes[file_path] = file_hash
+            if known_hashes.get(file_path) == file_hash:
+                continue
             # Read the Excel file into a pandas DataFrame
-            df = pd.read_excel(file_path, na_values=["无"], keep_default_na=True)
+            df = pd.read_excel(io.BytesIO(data), na_values=["无"], keep_default_na=True)
             # Rename the columns of the DataFrame
             df = df.rename(
                 columns={"标题": "title", "作者": "xlsx_author", "阅读量": "read"}
@@ -102,9 +415,11 @@ def xlsx2db(folder_path: str, collection: pymongo.collection.Collection) -> None
             data_dict = df.to_dict(orient="records")
             # Insert or update each record in the MongoDB collection
             for record in data_dict:
-                collection.update_one(
-                    {"title": record["title"]}, {"$set": record}, upsert=True
-                )
+                writer.upsert({"title": record["title"]}, record)
+            document_count += len(data_dict)
+    if own_writer:
+        writer.flush()
+    return document_count
 
 
 if __name__ == "__main__":
@@ -0,0 +1,222 @@
+'''
+it is a file that contains the indexes required by the pipeline and the report of the slow queries.
+Notes:
+1. every stage upserts its results on "title", so each collection needs an index on it, otherwise every upsert scans the collection and the writes get slower as the collection grows.
+2. the index on "title" is unique where a title identifies one document. When a collection already holds duplicate titles, a normal index is created instead and the duplicates are reported, process_mongo.delete_duplicates can remove them.
+3. the slow queries are recorded by the mongo profiler in system.profile when global_var.profile_slow_queries is set, the profiler needs the dbAdmin role, without it the report is skipped. The profiler slows down every client of the database, so its previous level is restored after the report. The local databases of storage.py have no profiler.
+'''
+
+
+from pymongo.database import Database
+from pymongo.errors import DuplicateKeyError, OperationFailure
+import global_var
+import storage
+
+# The code of the error raised when an index exists with the same name and other options
+INDEX_KEY_SPECS_CONFLICT = 86
+# The indexes of each collection, the options are passed to create_index
+INDEXES = {
+    "articles": [
+        {"keys": [("title", 1)], "unique": True},
+    ],
+    "indexs": [
+        {"keys": [("title", 1)], "unique": True},
+        # assign_topics and calculate_all look for the records which already have a field
+        {"keys": [("count_topic", 1)], "sparse": True},
+    ],
+    "demands": [
+        {"keys": [("title", 1)], "unique": True},
+    ],
+    "indexs_zh": [
+        {"keys": [("title", 1)], "unique": True},
+    ],
+    "merge": [
+        {"keys": [("title", 1)], "unique": True},
+    ],
+    global_var.vocabulary_collection_name: [
+        # A token has one id, see vocabulary.py
+        {"keys": [("kind", 1), ("token", 1)], "unique": True},
+    ],
+}
+
+
+def ensure_indexes(
+    database: Database, indexes: dict = None, allow_duplicates: bool = True
+) -> dict:
+    """
+    Creates the missing indexes of the collections.
+
+    Args:
+        database (Database): The MongoDB database.
+        indexes (dict, optional): The indexes of each collection. Defaults to INDEXES.
+        allow_duplicates (bool, optional): Create a normal index instead of a unique one
+            when the collection holds duplicate keys, otherwise the DuplicateKeyError is raised.
+
+    Returns:
+        dict: A dictionary mapping each collection and index name to what was done:
+            "exists", "created", "created not unique" or "exists not unique".
+    """
+    report = {}
+    for collection_name, specs in (indexes or INDEXES).items():
+        collection = database[collection_name]
+        existing = {
+            tuple((field, int(direction)) for field, direction in info["key"]): (name, info)
+            for name, info in collection.index_information().items()
+        }
+        for spec in specs:
+            keys = spec["keys"]
+            options = {option: value for option, value in spec.items() if option != "keys"}
+            if tuple(keys) in existing:
+                index_name, info = existing[tuple(keys)]
+                status = "exists"
+                if options.get("unique") and not info.get("unique"):
+                    status = "exists not unique"
+            else:
+                try:
+                    index_name = collection.create_index(keys, **options)
+                    status = "created"
+                except DuplicateKeyError as e:
+                    if not options.get("unique") or not allow_duplicates:
+                        raise
+                    # The collection holds duplicate keys, index it anyway
+                    print(f"{collection_name} has duplicate {keys}: {e}")
+                    options.pop("unique")
+                    index_name = collection.create_index(keys, **options)
+                    status = "created not unique"
+            report[f"{collection_name}.{index_name}"] = status
+    for index_name, status in report.items():
+        print(f"index {index_name}: {status}")
+    return report
+
+
+def ensure_unique_key(database: Database, collection_name: str, key: str) -> dict:
+    """
+    Creates the unique index on key needed to upsert or $merge into a collection built
+    from other collections (indexs_zh, merge, ...), the index of INDEXES when it is declared.
+
+    A normal index on key is replaced by the unique one. The collection is dropped, to be
+    built again by its stage, when it holds duplicate keys written by a version which
+    inserted instead of upserting, or an index of the same name on other keys.
+    The other errors (authorization, conflicting options, ...) are raised.
+
+    Args:
+        database (Database): The MongoDB database.
+        collection_name (str): The name of the derived collection.
+        key (str): The field the documents are upserted on.
+
+    Returns:
+        dict: The report of ensure_indexes.
+    """
+    specs = [
+        spec for spec in INDEXES.get(collection_name, []) if spec["keys"] == [(key, 1)]
+    ] or [{"keys": [(key, 1)], "unique": True}]
+    collection = database[collection_name]
+    for index_name, info in collection.index_information().items():
+        if [tuple(field) for field in info["key"]] == [(key, 1)] and not info.get("unique"):
+            collection.drop_index(index_name)
+    try:
+        return ensure_indexes(database, {collection_name: specs}, allow_duplicates=False)
+    except OperationFailure as e:
+        if not isinstance(e, DuplicateKeyError) and e.code != INDEX_KEY_SPECS_CONFLICT:
+            raise
+        print(f"rebuilding {collection_name}: {e}")
+        collection.drop()
+        return ensure_indexes(database, {collection_name: specs}, allow_duplicates=False)
+
+
+def enable_profiling(database: Database, slow_ms: int = global_var.SLOW_QUERY_MS) -> dict:
+    """
+    Records the operations slower than slow_ms milliseconds in system.profile.
+
+    Args:
+        database (Database): The MongoDB database.
+        slow_ms (int, optional): The threshold of a slow operation.
+
+    Returns:
+        dict: The previous level ('was') and threshold ('slowms') of the profiler, to be passed
+            to restore_profiling, None when the profiler could not be enabled.
+    """
+    if not storage.is_mongo(database):
+        return None
+    try:
+        previous = database.command("profile", -1)
+        database.command("profile", 1, slowms=slow_ms)
+    except OperationFailure as e:
+        print(f"the slow queries are not recorded: {e}")
+        return None
+    return {"was": previous["was"], "slowms": previous["slowms"]}
+
+
+def restore_profiling(database: Database, previous: dict) -> None:
+    """
+    Sets the profiler back to the level and threshold returned by enable_profiling.
+
+    Args:
+        database (Database): The MongoDB database.
+        previous (dict): The value returned by enable_profiling, nothing is done when it is None.
+    """
+    if previous is None:
+        return
+    try:
+        database.command("profile", previous["was"], slowms=previous["slowms"])
+    except OperationFailure as e:
+        print(f"the profiler level could not be restored: {e}")
+
+
+def report_slow_queries(database: Database, limit: int = 20) -> list:
+    """
+    Prints the slowest operations recorded by the profiler.
+
+    A "COLLSCAN" plan means the operation scanned the whole collection and an index is missing.
+
+    Args:
+        database (Database): The MongoDB database.
+        limit (int, optional): The number of operations to report.
+
+    Returns:
+        list: The reported operations, with their namespace, type, duration, plan and command.
+    """
+    if not storage.is_mongo(database):
+        return []
+    try:
+        operations = list(
+            database["system.profile"]
+            .find({}, {"_id": 0, "ns": 1, "op": 1, "millis": 1, "planSummary": 1, "command": 1})
+            .sort("millis", -1)
+            .limit(limit)
+        )
+    except OperationFailure as e:
+        print(f"the slow queries can not be read: {e}")
+        return []
+    for operation in operations:
+        print(
+            f"{operation.get('millis')} ms {operation.get('op')} {operation.get('ns')} "
+            f"{operation.get('planSummary', '')}"
+        )
+    return operations
+
+
+def bootstrap(database: Database) -> tuple[dict, dict]:
+    """
+    Prepares the database for a run of the pipeline: creates the indexes and enables the
+    profiler when global_var.profile_slow_queries is set.
+
+    Args:
+        database (Database): The MongoDB database.
+
+    Returns:
+        tuple[dict, dict]: The report of ensure_indexes and the value returned by
+            enable_profiling (None when the profiler is not enabled), to be passed to
+            restore_profiling at the end of the run.
+    """
+    report = ensure_indexes(database)
+    profiling = enable_profiling(database) if global_var.profile_slow_queries else None
+    return report, profiling
+
+
+if __name__ == "__main__":
+    from process_mongo import get_db
+
+    database = get_db()
+    ensure_indexes(database)
+    report_slow_queries(database)
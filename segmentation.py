@@ -0,0 +1,65 @@
+'''
+it is a file that contains the tokenization shared by every stage of the pipeline, each article is tokenized once by the segment stage.
+Notes:
+1. an article is cut twice, into words by jieba.lcut and into part-of-speech tags by jieba.posseg. jieba.posseg cuts some texts into other words than jieba.lcut, and taking the words from it changed the indexs and the sentiment of almost every test article, so both cuts are kept to give the same results as when every index cut the text again.
+2. the sentence boundaries are stored as token offsets, so the sentiment stage and the indexs can rebuild the sentences without calling jieba again.
+3. the tags are an independent sequence, which is not aligned index for index with the words and may have another length: the i-th tag is not the tag of the i-th word. The indexs only count the tags.
+'''
+
+
+import re
+import jieba
+import jieba.posseg as pseg
+from global_var import SENTENCE_SPLIT
+
+
+def tokenize_text(text: str) -> dict:
+    """
+    Tokenizes a text and records words, POS tags and sentence boundaries.
+
+    Args:
+        text (str): The text to tokenize.
+
+    Returns:
+        dict: A dictionary containing the following fields:
+            - text_seg: The list of words cut by jieba.lcut.
+            - pos_seg: The list of part-of-speech tags of the words cut by jieba.posseg.
+              These words are not always the words of text_seg, so pos_seg is not aligned
+              with text_seg and may have another length, only its counts are meaningful.
+            - sentence_ends: The exclusive end offset (in tokens) of each sentence.
+              A token containing k sentence marks closes k sentences, so the number of
+              sentences is the same as re.split(SENTENCE_SPLIT, text) gives.
+    """
+    split_pattern = re.compile(SENTENCE_SPLIT)
+    # Two cuts on purpose, see the notes of the module
+    words = jieba.lcut(text)
+    pos_list = [flag for word, flag in pseg.cut(text)]
+    sentence_ends = []
+    for index, word in enumerate(words):
+        # Close one sentence for every sentence mark in the token
+        sentence_ends.extend([index + 1] * len(split_pattern.findall(word)))
+    sentence_ends.append(len(words))
+    return {"text_seg": words, "pos_seg": pos_list, "sentence_ends": sentence_ends}
+
+
+def split_sentences(words: list, sentence_ends: list) -> list[list]:
+    """
+    Splits a token list into sentences using the offsets produced by tokenize_text.
+
+    Args:
+        words (list): The list of tokens of the whole text.
+        sentence_ends (list): The exclusive end offset of each sentence.
+
+    Returns:
+        list[list]: A list of sentences, each one is a list of tokens.
+    """
+    sentences = []
+    start = 0
+    for end in sentence_ends:
+        sentences.append(words[start:end])
+        start = end
+    return sentences
+
+
+if __name__ == "__main__":
+    print(tokenize_text("高血压是一种常见病。你知道吗？血压3.5怎么办！"))
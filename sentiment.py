@@ -1,41 +1,57 @@
 from collections import defaultdict
 import re
 import jieba
+import numpy as np
 import pandas as pd
 import pymongo
 from tqdm import tqdm
 import global_var
-from process_mongo import get_db
+import instrumentation
+from process_mongo import BulkWriter, get_db, unpack_array
+from segmentation import tokenize_text
+from vocabulary import WORD, Vocabulary, get_vocabulary_collection
 
+EMOTIONS = ["joy", "surprise", "anger", "sadness", "fear", "disgust"]
 
-def get_label_data(sentiment_dict_path:str = "data/sentiment.xlsx")->dict:
+
+def get_label_data(sentiment_dict_path:str = "data/sentiment/sentiment.xlsx")->dict:
     """
     Reads sentiment data from an Excel file and returns a dictionary of labeled data.
+    The result is kept by global_var.load_resource, so the Excel file is only read
+    again when it changes, and it is shared by every caller: copy it before changing it.
 
     Args:
         sentiment_dict_path (str): The path to the Excel file containing the sentiment data. 
-        Defaults to "data/sentiment.xlsx".
+        Defaults to "data/sentiment/sentiment.xlsx".
 
     Returns:
         dict: A dictionary containing labeled data, where the keys are the sentiment categories
         ("joy", "surprise", "anger", "sadness", "fear", "disgust") and the values are
         dictionaries mapping words to sentiment scores.
     """
-    # Read sentiment data from the Excel file
-    sem_data = pd.read_excel(sentiment_dict_path)
-    # Iterate over each row in the data
-    for i in range(sem_data.shape[0]):
-        score = 0
-
-        # Convert sentiment values of 2 to -1
-        if sem_data.iloc[i, 6] == 2:
-            sem_data.iat[i, 6] = -1
-        if sem_data.iloc[i, 9] == 2:
-            sem_data.iat[i, 9] = -1
-
-        # Calculate the score based on the sentiment values
-        score += sem_data.iloc[i, 5] * sem_data.iloc[i, 6]
-        sem_data.iat[i, -1] = score
+    return global_var.load_resource(
+        "label_data",
+        [sentiment_dict_path],
+        lambda: _build_label_data(pd.read_excel(sentiment_dict_path)),
+    )
+
+
+def _build_label_data(sem_data: pd.DataFrame) -> dict:
+    """
+    Builds the labeled data of get_label_data from the sentiment sheet with column operations.
+
+    Args:
+        sem_data (pd.DataFrame): The sentiment sheet, the columns used are the word (0),
+            the sentiment category (4), the strength (5) and the polarity (6).
+
+    Returns:
+        dict: The labeled data, see get_label_data.
+    """
+    # Convert sentiment values of 2 to -1 and calculate the score
+    polarity = sem_data.iloc[:, 6].replace(2, -1)
+    scores = (sem_data.iloc[:, 5] * polarity).astype(float)
+    words = sem_data.iloc[:, 0]
+    labels = sem_data.iloc[:, 4]
     # Define a dictionary to store the labeled data
     match_dict = {
         "joy": ["PA", "PE"],
@@ -46,19 +62,10 @@ def get_label_data(sentiment_dict_path:str = "data/sentiment.xlsx")->dict:
         "disgust": ["ND", "NE", "NN", "NK", "NL"],
     }
     label_dict = {}
-    # Iterate over each sentiment category
-    keys = match_dict.keys()
-    for k in keys:
-        word_dict = {}
-        # Iterate over each row in the data
-        for i in range(sem_data.shape[0]):
-            label = sem_data.iloc[i, 4]
-            # Check if the label matches the sentiment category
-            if label in match_dict[k]:
-                word_dict[sem_data.iloc[i, 0]] = sem_data.iloc[i, -1]
-        # Add the word dictionary to the label dictionary
-        label_dict[k] = word_dict
-    # Return the labeled data dictionary
+    for k, labels_of_k in match_dict.items():
+        # Later rows overwrite earlier rows of the same word
+        mask = labels.isin(labels_of_k)
+        label_dict[k] = dict(zip(words[mask].tolist(), scores[mask].tolist()))
     return label_dict
 
 
@@ -76,6 +83,20 @@ def calculate_sentiment_sentence(sentence:str, sentiment_dict:dict) -> int:
     """
     # 分词
     words = jieba.lcut(sentence)
+    return calculate_sentiment_words(words, sentiment_dict)
+
+
+def calculate_sentiment_words(words:list, sentiment_dict:dict) -> int:
+    """
+    Calculate the sentiment score of an already segmented sentence.
+
+    Args:
+        words (list): The tokens of the sentence.
+        sentiment_dict (dict): A dictionary containing sentiment scores for different words.
+
+    Returns:
+        int: The total sentiment score of the sentence.
+    """
     # 计算情感值
     sentiment_scores = defaultdict(int)
     for word in words:
@@ -127,37 +148,218 @@ def calculate_sentiment_text(text: str, sentiment_dict: dict) -> dict:
     return {"sentiment_list": sentiment_list}
 
 
-def get_sentiment_list(sentiment_dict:dict,read_collection:pymongo.collection.Collection,wrote_collection:pymongo.collection.Collection)->None:
+def compile_sentiment_dict(sentiment_dict: dict) -> dict:
     """
-    Retrieves the sentiment of articles from a given database and updates/inserts the sentiment scores.
+    Compiles the sentiment dictionary into a word ID map and a score matrix.
 
     Args:
-        database (pymongo.database.Database): The database containing the articles.
+        sentiment_dict (dict): A dictionary containing sentiment scores for different emotions.
 
     Returns:
-        dict: A dictionary containing the counts of updated and inserted records.
-    """
-    records = list(read_collection.find())
-    bulk_updates = []
-    for record in tqdm(records, desc='Processing records sentiment_list',total=len(records)):
-        if "text" not in record.keys():
-            tqdm.write(f'Text not found in record with title = {record.get("title")}')
-        else:
-            text = record["text"]
-            new_record = calculate_sentiment_text(text, sentiment_dict)
-            new_record.update({"title": record["title"]})
-            bulk_updates.append(
-                pymongo.UpdateOne(
-                    {"title": new_record["title"]}, {"$set": new_record}, upsert=True
-                )
+        dict: A dictionary containing the following keys:
+            - word_ids: A dictionary mapping each word to its row in scores, 0 is kept for unknown words.
+            - scores: A float array of shape (len(word_ids) + 1, len(EMOTIONS)).
+    """
+    words = sorted(set().union(*(sentiment_dict[emotion] for emotion in EMOTIONS)))
+    word_ids = {word: index + 1 for index, word in enumerate(words)}
+    scores = np.zeros((len(words) + 1, len(EMOTIONS)))
+    for column, emotion in enumerate(EMOTIONS):
+        for word, score in sentiment_dict[emotion].items():
+            scores[word_ids[word], column] = score
+    return {"word_ids": word_ids, "scores": scores}
+
+
+def calculate_sentiment_tokens(words: list, sentence_ends: list, compiled_dict: dict) -> dict:
+    """
+    Calculate the sentiment score for each sentence of a text segmented by the segment stage.
+    The whole text is scored at once with NumPy instead of sentence by sentence.
+
+    Args:
+        words (list): The tokens of the whole text ('text_seg').
+        sentence_ends (list): The exclusive end offset of each sentence ('sentence_ends').
+        compiled_dict (dict): The sentiment dictionary compiled by compile_sentiment_dict.
+
+    Returns:
+        dict: A dictionary containing the following keys:
+            - sentiment_list: The same scores as calculate_sentiment_text, one for each sentence.
+            - sentiment_emotion: The total score of each emotion in the text.
+    """
+    word_ids = compiled_dict["word_ids"]
+    rows = np.fromiter(
+        (word_ids.get(word, 0) for word in words), dtype=np.int64, count=len(words)
+    )
+    return calculate_sentiment_rows(rows, sentence_ends, compiled_dict["scores"])
+
+
+def compile_sentiment_ids(compiled_dict: dict, words: Vocabulary) -> np.ndarray:
+    """
+    Maps the token ids of a vocabulary to the rows of the compiled sentiment dictionary.
+
+    Args:
+        compiled_dict (dict): The sentiment dictionary compiled by compile_sentiment_dict.
+        words (Vocabulary): The word vocabulary.
+
+    Returns:
+        np.ndarray: The row in compiled_dict["scores"] of each token id, 0 for the words without score.
+    """
+    id_rows = np.zeros(len(words), dtype=np.int64)
+    for word, row in compiled_dict["word_ids"].items():
+        token_id = words.ids.get(word)
+        if token_id is not None:
+            id_rows[token_id] = row
+    return id_rows
+
+
+def calculate_sentiment_ids(
+    token_ids: np.ndarray, sentence_ends, id_rows: np.ndarray, scores: np.ndarray
+) -> dict:
+    """
+    Calculate the sentiment score of each sentence like calculate_sentiment_tokens, on the
+    token ids stored by the segment stage.
+
+    Args:
+        token_ids (np.ndarray): The token ids of the whole text ('token_ids').
+        sentence_ends: The exclusive end offset of each sentence ('sentence_ends').
+        id_rows (np.ndarray): The rows of each token id returned by compile_sentiment_ids.
+        scores (np.ndarray): The score matrix of the compiled sentiment dictionary.
+
+    Returns:
+        dict: The same result as calculate_sentiment_tokens.
+    """
+    # The ids given after id_rows was built have no score
+    known = token_ids < len(id_rows)
+    rows = np.zeros(len(token_ids), dtype=np.int64)
+    rows[known] = id_rows[token_ids[known]]
+    return calculate_sentiment_rows(rows, sentence_ends, scores)
+
+
+def calculate_sentiment_rows(rows: np.ndarray, sentence_ends, scores: np.ndarray) -> dict:
+    """
+    Sums the scores of the tokens of each sentence with np.bincount.
+
+    Args:
+        rows (np.ndarray): The row in scores of each token, 0 for the tokens without score.
+        sentence_ends: The exclusive end offset of each sentence.
+        scores (np.ndarray): The score matrix of the compiled sentiment dictionary.
+
+    Returns:
+        dict: The same result as calculate_sentiment_tokens.
+    """
+    # The sentence of each token
+    sentence_ids = np.repeat(
+        np.arange(len(sentence_ends)), np.diff(sentence_ends, prepend=0)
+    )
+    token_scores = scores[rows]
+    emotion_scores = np.stack(
+        [
+            np.bincount(
+                sentence_ids,
+                weights=token_scores[:, column],
+                minlength=len(sentence_ends),
             )
+            for column in range(len(EMOTIONS))
+        ],
+        axis=1,
+    )
+    return {
+        "sentiment_list": emotion_scores.sum(axis=1).astype(int).tolist(),
+        "sentiment_emotion": dict(zip(EMOTIONS, emotion_scores.sum(axis=0).tolist())),
+    }
+
+
+def get_sentiment_list(sentiment_dict:dict,read_collection:pymongo.collection.Collection,wrote_collection:pymongo.collection.Collection,incremental:bool=False)->None:
+    """
+    Retrieves the sentiment of articles from a given database and updates/inserts the sentiment scores.
+    The token ids and sentence boundaries stored by the segment stage are used when they exist,
+    then the tokens stored by the previous versions, otherwise the text is tokenized here.
+
+    Args:
+        sentiment_dict (dict): A dictionary containing sentiment scores for words.
+        read_collection (pymongo.collection.Collection): The collection containing the articles.
+        wrote_collection (pymongo.collection.Collection): The collection to write the sentiment scores to.
+        incremental (bool, optional): Skip the records whose scores were calculated from their
+            current content_hash and segmentation, so an interrupted run continues where it stopped.
 
-    if bulk_updates:
-        wrote_collection.bulk_write(bulk_updates)
+    Returns:
+        None
+    """
+    compiled_dict = compile_sentiment_dict(sentiment_dict)
+    id_rows = compile_sentiment_ids(
+        compiled_dict, Vocabulary(get_vocabulary_collection(read_collection), WORD)
+    )
+    calculated_hashes = {}
+    if incremental:
+        calculated_hashes = {
+            record["title"]: record["sentiment_hash"]
+            for record in wrote_collection.find(
+                {"sentiment_hash": {"$exists": True}},
+                {"_id": 0, "title": 1, "sentiment_hash": 1},
+            )
+        }
+    records = read_collection.find(
+        {},
+        {
+            "_id": 0,
+            "title": 1,
+            "text": 1,
+            "token_ids": 1,
+            "text_seg": 1,
+            "sentence_ends": 1,
+            "content_hash": 1,
+            "segment_version": 1,
+        },
+    )
+    skipped = 0
+    with BulkWriter(wrote_collection) as writer:
+        for record in tqdm(
+            instrumentation.timed_iter(records, f"mongo.read.{read_collection.name}"),
+            desc='Processing records sentiment_list',
+        ):
+            if "text" not in record.keys():
+                tqdm.write(f'Text not found in record with title = {record.get("title")}')
+            elif (
+                record.get("content_hash") is not None
+                and calculated_hashes.get(record["title"]) == _sentiment_hash(record)
+            ):
+                skipped += 1
+            else:
+                if "token_ids" in record:
+                    new_record = instrumentation.call(
+                        "metric.calculate_sentiment_ids",
+                        calculate_sentiment_ids,
+                        unpack_array(record["token_ids"]),
+                        unpack_array(record["sentence_ends"]),
+                        id_rows,
+                        compiled_dict["scores"],
+                    )
+                else:
+                    if "text_seg" not in record or "sentence_ends" not in record:
+                        record.update(tokenize_text(record["text"]))
+                    new_record = instrumentation.call(
+                        "metric.calculate_sentiment_tokens",
+                        calculate_sentiment_tokens,
+                        record["text_seg"],
+                        record["sentence_ends"],
+                        compiled_dict,
+                    )
+                new_record.update({"title": record["title"]})
+                if record.get("content_hash") is not None:
+                    new_record["sentiment_hash"] = _sentiment_hash(record)
+                writer.upsert({"title": new_record["title"]}, new_record)
+    print(f"sentiment_list were successfully wrote: {writer.summary()}, {skipped} unchanged skipped")
     return None
 
 
+def _sentiment_hash(record: dict) -> str:
+    """
+    Identifies the tokens the sentiment of an article is calculated from, its content_hash
+    and the SEGMENT_VERSION of its segmentation.
+    """
+    return f'{record["content_hash"]}:{record.get("segment_version")}'
+
+
 if __name__ == "__main__":
 
     sentiment_dict = global_var.get_sentiment_dict()
-    get_sentiment_list(sentiment_dict,get_db(),'articles','indexs')
+    database = get_db()
+    get_sentiment_list(sentiment_dict,database['articles'],database['articles'])
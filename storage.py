@@ -0,0 +1,735 @@
+'''
+it is a file that contains the storage backends of the pipeline: a mongo server, a local sqlite file or the memory.
+Notes:
+1. get_database(url, name) returns the database of "mongodb://host:port/", "sqlite:///path/to/file.db" or "memory://". The sqlite and memory databases implement the part of the pymongo API used by the pipeline, so the pipeline runs on a laptop without the mongo server of the lan network.
+2. the local collections support the filters with equalities, $in, $nin, $exists, $eq, $ne, $gt, $gte, $lt, $lte, $regex, $or, $and and $nor, the projections, the sort, skip, limit and batch_size of the cursors, and the UpdateOne ($set, $unset, $inc), UpdateMany, ReplaceOne, InsertOne, DeleteOne and DeleteMany writes.
+3. the aggregation pipelines need the mongo server, process_mongo.map_fields and process_mongo.merge use their batched and chunked methods on the local databases.
+4. the local collections index the documents by _id and title, the other filters are evaluated in python. A unique index is checked when it is created but not enforced on the later writes, the pipeline upserts on title so it does not write duplicates.
+5. the sqlite file keeps one table per collection with each document pickled in a row, and every bulk_write is one transaction.
+'''
+
+
+import os
+import pickle
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from types import SimpleNamespace
+from bson import ObjectId
+from pymongo import (
+    DeleteMany,
+    DeleteOne,
+    InsertOne,
+    MongoClient,
+    ReplaceOne,
+    UpdateMany,
+    UpdateOne,
+)
+from pymongo.database import Database
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+# The memory databases of this process, name -> MemoryDatabase, so every get_database call shares them
+_memory_databases = {}
+
+
+def get_database(url: str, name: str):
+    """
+    Connects to the database of a url.
+
+    Args:
+        url (str): "mongodb://..." (or "mongodb+srv://..."), "sqlite:///path" or "memory://".
+            The sqlite path is the database file when it ends with ".db" or ".sqlite",
+            otherwise it is a folder containing "<name>.sqlite".
+        name (str): The name of the database.
+
+    Returns:
+        Database: A pymongo Database, a SQLiteDatabase or a MemoryDatabase.
+
+    Raises:
+        ValueError: If the scheme of the url is not supported.
+    """
+    if url.startswith(("mongodb://", "mongodb+srv://")):
+        return MongoClient(url)[name]
+    if url.startswith("sqlite:///"):
+        path = url[len("sqlite:///"):]
+        if not path.endswith((".db", ".sqlite")):
+            os.makedirs(path, exist_ok=True)
+            path = os.path.join(path, f"{name}.sqlite")
+        return SQLiteDatabase(path, name)
+    if url.startswith("memory://"):
+        if name not in _memory_databases:
+            _memory_databases[name] = MemoryDatabase(name)
+        return _memory_databases[name]
+    raise ValueError(f"unsupported database url: {url}")
+
+
+def is_mongo(database) -> bool:
+    """
+    Checks if a database is served by mongo, and so supports the aggregation pipelines.
+    """
+    return isinstance(database, Database)
+
+
+def _key(value) -> str:
+    """
+    Returns the text key of an _id or a title, used by the indexes of the local collections.
+    """
+    if isinstance(value, (str, int, float, ObjectId)) and not isinstance(value, bool):
+        return f"{type(value).__name__}:{value}"
+    return f"repr:{value!r}"
+
+
+def _get_field(document: dict, field: str) -> tuple:
+    """
+    Returns whether a field, which may be dotted, is present in a document, and its value.
+    """
+    value = document
+    for part in field.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return False, None
+        value = value[part]
+    return True, value
+
+
+def _compare(operator: str, value, operand) -> bool:
+    try:
+        if operator == "$gt":
+            return value > operand
+        if operator == "$gte":
+            return value >= operand
+        if operator == "$lt":
+            return value < operand
+        return value <= operand
+    except TypeError:
+        # Values of different types are never ordered
+        return False
+
+
+def _match_condition(present: bool, value, operator: str, operand) -> bool:
+    """
+    Checks a field against one operator of a filter.
+    """
+    if operator == "$exists":
+        return present == bool(operand)
+    if operator == "$eq":
+        return value == operand if present else operand is None
+    if operator == "$ne":
+        return not _match_condition(present, value, "$eq", operand)
+    if operator == "$in":
+        return any(_match_condition(present, value, "$eq", item) for item in operand)
+    if operator == "$nin":
+        return not _match_condition(present, value, "$in", operand)
+    if operator in ("$gt", "$gte", "$lt", "$lte"):
+        return present and value is not None and _compare(operator, value, operand)
+    if operator == "$regex":
+        return isinstance(value, str) and re.search(operand, value) is not None
+    raise NotImplementedError(f"unsupported operator: {operator}")
+
+
+def match(document: dict, filter_query: dict) -> bool:
+    """
+    Checks if a document matches a mongo filter.
+
+    Args:
+        document (dict): The document.
+        filter_query (dict): The filter, see the notes of the module for the supported operators.
+
+    Returns:
+        bool: Whether the document matches.
+    """
+    for field, condition in filter_query.items():
+        if field == "$or":
+            if not any(match(document, sub_query) for sub_query in condition):
+                return False
+        elif field == "$and":
+            if not all(match(document, sub_query) for sub_query in condition):
+                return False
+        elif field == "$nor":
+            if any(match(document, sub_query) for sub_query in condition):
+                return False
+        else:
+            present, value = _get_field(document, field)
+            if isinstance(condition, dict) and condition and all(
+                operator.startswith("$") for operator in condition
+            ):
+                for operator, operand in condition.items():
+                    if operator == "$options":
+                        continue
+                    if not _match_condition(present, value, operator, operand):
+                        return False
+            elif isinstance(condition, re.Pattern):
+                if not (isinstance(value, str) and condition.search(value)):
+                    return False
+            elif not _match_condition(present, value, "$eq", condition):
+                return False
+    return True
+
+
+def project(document: dict, projection: dict = None) -> dict:
+    """
+    Returns a copy of the fields of a document selected by a mongo projection.
+    """
+    if not projection:
+        return dict(document)
+    included = [
+        field for field, value in projection.items() if value and field != "_id"
+    ]
+    if included:
+        projected = {field: document[field] for field in included if field in document}
+        if projection.get("_id", 1) and "_id" in document:
+            projected["_id"] = document["_id"]
+        return projected
+    return {
+        field: value for field, value in document.items() if projection.get(field, 1)
+    }
+
+
+def apply_update(document: dict, update: dict, inserting: bool = False) -> dict:
+    """
+    Applies the $set, $unset, $inc and $setOnInsert operators of an update to a document in place.
+    """
+    for operator, fields in update.items():
+        if operator == "$set" or (operator == "$setOnInsert" and inserting):
+            document.update(fields)
+        elif operator == "$unset":
+            for field in fields:
+                document.pop(field, None)
+        elif operator == "$inc":
+            for field, value in fields.items():
+                document[field] = document.get(field, 0) + value
+        elif operator != "$setOnInsert":
+            raise NotImplementedError(f"unsupported update operator: {operator}")
+    return document
+
+
+def _upserted_document(filter_query: dict) -> dict:
+    """
+    Returns the fields of a new document upserted by a filter, which are its equalities.
+    """
+    return {
+        field: value
+        for field, value in filter_query.items()
+        if not field.startswith("$")
+        and "." not in field
+        and not (isinstance(value, dict) and any(key.startswith("$") for key in value))
+    }
+
+
+def _result(**counts) -> SimpleNamespace:
+    """
+    Returns a write result with the attributes of the pymongo results.
+    """
+    result = {
+        "acknowledged": True,
+        "matched_count": 0,
+        "modified_count": 0,
+        "upserted_count": 0,
+        "inserted_count": 0,
+        "deleted_count": 0,
+        "upserted_id": None,
+        "inserted_id": None,
+        "inserted_ids": [],
+    }
+    result.update(counts)
+    return SimpleNamespace(**result)
+
+
+class LocalCursor:
+    """
+    The cursor of a local collection. The keys of the candidate documents are read when the
+    iteration starts, then the documents are loaded batch_size at a time, so the collection
+    can be written while a cursor is read.
+    """
+
+    def __init__(self, collection, filter_query: dict = None, projection=None) -> None:
+        self.collection = collection
+        self.filter_query = filter_query or {}
+        if isinstance(projection, (list, tuple)):
+            projection = {field: 1 for field in projection}
+        self.projection = projection
+        self.sort_keys = None
+        self.skip_count = 0
+        self.limit_count = 0
+        self.size = 1000
+        self.iterator = None
+
+    def sort(self, key_or_list, direction: int = 1) -> "LocalCursor":
+        if isinstance(key_or_list, str):
+            key_or_list = [(key_or_list, direction)]
+        self.sort_keys = list(key_or_list)
+        return self
+
+    def skip(self, count: int) -> "LocalCursor":
+        self.skip_count = count
+        return self
+
+    def limit(self, count: int) -> "LocalCursor":
+        self.limit_count = count
+        return self
+
+    def batch_size(self, size: int) -> "LocalCursor":
+        self.size = max(size, 1)
+        return self
+
+    def _matching(self):
+        """
+        Yields the matching documents in the order of the collection.
+        """
+        keys = self.collection._candidate_keys(self.filter_query)
+        for start in range(0, len(keys), self.size):
+            for document in self.collection._load(keys[start : start + self.size]):
+                if match(document, self.filter_query):
+                    yield document
+
+    def _documents(self):
+        documents = self._matching()
+        if self.sort_keys:
+            # Only the sort values and the keys are kept to sort, the documents are loaded again
+            ordered = [
+                (
+                    [_sort_value(document, field) for field, _ in self.sort_keys],
+                    _key(document["_id"]),
+                )
+                for document in documents
+            ]
+            for position in reversed(range(len(self.sort_keys))):
+                ordered.sort(
+                    key=lambda item: item[0][position],
+                    reverse=self.sort_keys[position][1] < 0,
+                )
+            keys = [key for _, key in ordered]
+
+            def sorted_documents():
+                for start in range(0, len(keys), self.size):
+                    yield from self.collection._load(keys[start : start + self.size])
+
+            documents = sorted_documents()
+        yielded = 0
+        for position, document in enumerate(documents):
+            if position < self.skip_count:
+                continue
+            if self.limit_count and yielded >= self.limit_count:
+                return
+            yielded += 1
+            yield project(document, self.projection)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> dict:
+        if self.iterator is None:
+            self.iterator = self._documents()
+        return next(self.iterator)
+
+
+def _sort_value(document: dict, field: str) -> tuple:
+    """
+    Returns a sort value of a field, the missing and None values are sorted first.
+    """
+    present, value = _get_field(document, field)
+    if not present or value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return (1, value)
+    return (2, type(value).__name__, value)
+
+
+class LocalCollection:
+    """
+    The pymongo collection API over the storage of a local collection.
+
+    The storage is implemented by the subclasses with _candidate_keys, _load, _save, _remove and _transaction.
+    """
+
+    def __init__(self, database, name: str) -> None:
+        self.database = database
+        self.name = name
+        self.full_name = f"{database.name}.{name}"
+        self.indexes = {"_id_": {"key": [("_id", 1)], "v": 2}}
+
+    def find(self, filter_query: dict = None, projection=None, **kwargs) -> LocalCursor:
+        cursor = LocalCursor(self, filter_query, projection)
+        if kwargs.get("sort"):
+            cursor.sort(kwargs["sort"])
+        cursor.skip(kwargs.get("skip", 0)).limit(kwargs.get("limit", 0))
+        return cursor
+
+    def find_one(self, filter_query: dict = None, projection=None):
+        for document in self.find(filter_query, projection).limit(1):
+            return document
+        return None
+
+    def count_documents(self, filter_query: dict, **kwargs) -> int:
+        return sum(1 for _ in self.find(filter_query, {"_id": 1}, **kwargs))
+
+    def estimated_document_count(self) -> int:
+        return len(self._candidate_keys({}))
+
+    def distinct(self, field: str, filter_query: dict = None) -> list:
+        values = []
+        for document in self.find(filter_query):
+            present, value = _get_field(document, field)
+            if present and value not in values:
+                values.append(value)
+        return values
+
+    def insert_one(self, document: dict) -> SimpleNamespace:
+        result = self.bulk_write([InsertOne(document)])
+        return _result(inserted_id=result.inserted_ids[0], inserted_count=1)
+
+    def insert_many(self, documents: list, ordered: bool = True) -> SimpleNamespace:
+        result = self.bulk_write([InsertOne(document) for document in documents])
+        return _result(inserted_ids=result.inserted_ids, inserted_count=len(documents))
+
+    def update_one(self, filter_query: dict, update: dict, upsert: bool = False) -> SimpleNamespace:
+        return self.bulk_write([UpdateOne(filter_query, update, upsert=upsert)])
+
+    def update_many(self, filter_query: dict, update: dict, upsert: bool = False) -> SimpleNamespace:
+        return self.bulk_write([UpdateMany(filter_query, update, upsert=upsert)])
+
+    def replace_one(self, filter_query: dict, replacement: dict, upsert: bool = False) -> SimpleNamespace:
+        return self.bulk_write([ReplaceOne(filter_query, replacement, upsert=upsert)])
+
+    def delete_one(self, filter_query: dict) -> SimpleNamespace:
+        return self.bulk_write([DeleteOne(filter_query)])
+
+    def delete_many(self, filter_query: dict) -> SimpleNamespace:
+        return self.bulk_write([DeleteMany(filter_query)])
+
+    def bulk_write(self, operations: list, ordered: bool = True) -> SimpleNamespace:
+        """
+        Applies pymongo write operations in one transaction.
+        """
+        counts = {
+            "matched_count": 0,
+            "modified_count": 0,
+            "upserted_count": 0,
+            "inserted_count": 0,
+            "deleted_count": 0,
+        }
+        inserted_ids = []
+        upserted_id = None
+        with self._transaction():
+            for operation in operations:
+                if isinstance(operation, InsertOne):
+                    document = dict(operation._doc)
+                    document.setdefault("_id", ObjectId())
+                    # pymongo also sets the _id of the inserted document
+                    operation._doc.setdefault("_id", document["_id"])
+                    self._save([document])
+                    inserted_ids.append(document["_id"])
+                    counts["inserted_count"] += 1
+                    continue
+                multi = isinstance(operation, (UpdateMany, DeleteMany))
+                targets = self._targets(operation._filter, multi)
+                if isinstance(operation, (DeleteOne, DeleteMany)):
+                    self._remove([_key(document["_id"]) for document in targets])
+                    counts["deleted_count"] += len(targets)
+                    continue
+                if not isinstance(operation, (UpdateOne, UpdateMany, ReplaceOne)):
+                    raise NotImplementedError(f"unsupported operation: {operation}")
+                replace = isinstance(operation, ReplaceOne)
+                for document in targets:
+                    if replace:
+                        document = {"_id": document["_id"], **operation._doc}
+                    else:
+                        apply_update(document, operation._doc)
+                    self._save([document])
+                counts["matched_count"] += len(targets)
+                counts["modified_count"] += len(targets)
+                if not targets and operation._upsert:
+                    document = _upserted_document(operation._filter)
+                    if replace:
+                        document.update(operation._doc)
+                    else:
+                        apply_update(document, operation._doc, inserting=True)
+                    document.setdefault("_id", ObjectId())
+                    self._save([document])
+                    upserted_id = document["_id"]
+                    counts["upserted_count"] += 1
+        return _result(inserted_ids=inserted_ids, upserted_id=upserted_id, **counts)
+
+    def _targets(self, filter_query: dict, multi: bool) -> list:
+        """
+        Returns the stored documents matched by the filter of a write.
+        """
+        targets = []
+        for document in self._load(self._candidate_keys(filter_query)):
+            if match(document, filter_query):
+                targets.append(document)
+                if not multi:
+                    break
+        return targets
+
+    def create_index(self, keys, unique: bool = False, **options) -> str:
+        """
+        Records an index, a unique index is refused when the collection holds duplicate keys.
+
+        Raises:
+            DuplicateKeyError: If unique and two documents have the same key.
+        """
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        keys = list(keys)
+        name = options.get("name") or "_".join(f"{field}_{direction}" for field, direction in keys)
+        if unique:
+            seen = set()
+            for document in self.find({}, {field: 1 for field, _ in keys}):
+                key = tuple(_key(_get_field(document, field)[1]) for field, _ in keys)
+                if key in seen:
+                    raise DuplicateKeyError(
+                        f"E11000 duplicate key error collection: {self.full_name} index: {name}",
+                        11000,
+                    )
+                seen.add(key)
+        self.indexes[name] = {"key": keys, "v": 2}
+        if unique:
+            self.indexes[name]["unique"] = True
+        if options.get("sparse"):
+            self.indexes[name]["sparse"] = True
+        return name
+
+    def index_information(self) -> dict:
+        return {name: dict(info) for name, info in self.indexes.items()}
+
+    def drop_index(self, name: str) -> None:
+        self.indexes.pop(name)
+
+    def drop(self) -> None:
+        with self._transaction():
+            self._remove(self._candidate_keys({}))
+        self.indexes = {"_id_": {"key": [("_id", 1)], "v": 2}}
+
+    def aggregate(self, pipeline: list, **kwargs):
+        raise NotImplementedError(
+            "the aggregation pipelines need a mongo server, "
+            "use the batched or chunked methods of process_mongo on a local database"
+        )
+
+    def _equality_keys(self, filter_query: dict, field: str):
+        """
+        Returns the keys of the values a filter requires for a field, None when any value can match.
+        """
+        condition = filter_query.get(field)
+        if condition is None and field in filter_query:
+            return None
+        if isinstance(condition, dict):
+            if set(condition) == {"$in"}:
+                return [_key(value) for value in condition["$in"]]
+            if set(condition) == {"$eq"}:
+                return [_key(condition["$eq"])]
+            return None
+        if field in filter_query and not isinstance(condition, re.Pattern):
+            return [_key(condition)]
+        return None
+
+
+class MemoryCollection(LocalCollection):
+    """
+    A local collection kept in python dictionaries.
+    """
+
+    def __init__(self, database, name: str) -> None:
+        super().__init__(database, name)
+        self.documents = {}
+        self.titles = {}
+        self.lock = threading.RLock()
+
+    def _candidate_keys(self, filter_query: dict) -> list:
+        with self.lock:
+            keys = self._equality_keys(filter_query, "_id")
+            if keys is not None:
+                return [key for key in dict.fromkeys(keys) if key in self.documents]
+            title_keys = self._equality_keys(filter_query, "title")
+            if title_keys is not None:
+                candidates = set()
+                for title_key in title_keys:
+                    candidates |= self.titles.get(title_key, set())
+                # Keep the order of insertion
+                return [key for key in self.documents if key in candidates]
+            return list(self.documents)
+
+    def _load(self, keys: list) -> list:
+        with self.lock:
+            # The stored documents are copied so the caller can not change them
+            return [dict(self.documents[key]) for key in keys if key in self.documents]
+
+    def _save(self, documents: list) -> None:
+        with self.lock:
+            for document in documents:
+                key = _key(document["_id"])
+                previous = self.documents.get(key)
+                if previous is not None and "title" in previous:
+                    self.titles.get(_key(previous["title"]), set()).discard(key)
+                self.documents[key] = dict(document)
+                if "title" in document:
+                    self.titles.setdefault(_key(document["title"]), set()).add(key)
+
+    def _remove(self, keys: list) -> None:
+        with self.lock:
+            for key in keys:
+                document = self.documents.pop(key, None)
+                if document is not None and "title" in document:
+                    self.titles.get(_key(document["title"]), set()).discard(key)
+
+    @contextmanager
+    def _transaction(self):
+        with self.lock:
+            yield
+
+
+class SQLiteCollection(LocalCollection):
+    """
+    A local collection stored in a table of a sqlite file, one pickled document per row.
+    """
+
+    def __init__(self, database, name: str) -> None:
+        super().__init__(database, name)
+        self.table = '"' + name.replace('"', '""') + '"'
+        with database.lock:
+            database.connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} "
+                "(key TEXT PRIMARY KEY, title TEXT, document BLOB)"
+            )
+            index_name = '"' + f"{name}_title".replace('"', '""') + '"'
+            database.connection.execute(
+                f"CREATE INDEX IF NOT EXISTS {index_name} ON {self.table} (title)"
+            )
+            database.connection.commit()
+
+    def _candidate_keys(self, filter_query: dict) -> list:
+        connection = self.database.connection
+        with self.database.lock:
+            for field, column in (("_id", "key"), ("title", "title")):
+                keys = self._equality_keys(filter_query, field)
+                if keys is None:
+                    continue
+                found = {}
+                for start in range(0, len(keys), 500):
+                    chunk = keys[start : start + 500]
+                    found.update(
+                        connection.execute(
+                            f"SELECT key, rowid FROM {self.table} WHERE {column} IN "
+                            f"({','.join('?' * len(chunk))})",
+                            chunk,
+                        )
+                    )
+                # Keep the order of insertion
+                return sorted(found, key=found.get)
+            return [
+                row[0]
+                for row in connection.execute(f"SELECT key FROM {self.table} ORDER BY rowid")
+            ]
+
+    def _load(self, keys: list) -> list:
+        documents = {}
+        with self.database.lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start : start + 500]
+                for key, document in self.database.connection.execute(
+                    f"SELECT key, document FROM {self.table} WHERE key IN "
+                    f"({','.join('?' * len(chunk))})",
+                    chunk,
+                ):
+                    documents[key] = pickle.loads(document)
+        return [documents[key] for key in keys if key in documents]
+
+    def _save(self, documents: list) -> None:
+        rows = [
+            (
+                _key(document["_id"]),
+                _key(document["title"]) if "title" in document else None,
+                pickle.dumps(document, protocol=pickle.HIGHEST_PROTOCOL),
+            )
+            for document in documents
+        ]
+        with self.database.lock:
+            # An update keeps the rowid of the row, so the order of the documents does not change
+            self.database.connection.executemany(
+                f"INSERT INTO {self.table} (key, title, document) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET title = excluded.title, document = excluded.document",
+                rows,
+            )
+
+    def _remove(self, keys: list) -> None:
+        with self.database.lock:
+            self.database.connection.executemany(
+                f"DELETE FROM {self.table} WHERE key = ?", [(key,) for key in keys]
+            )
+
+    @contextmanager
+    def _transaction(self):
+        with self.database.lock:
+            try:
+                yield
+            except BaseException:
+                self.database.connection.rollback()
+                raise
+            self.database.connection.commit()
+
+
+class LocalDatabase:
+    """
+    The pymongo database API over local collections, the collections are created when they are first used.
+    """
+
+    collection_class = None
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.collections = {}
+        self.lock = threading.RLock()
+
+    def __getitem__(self, name: str) -> LocalCollection:
+        with self.lock:
+            if name not in self.collections:
+                self.collections[name] = self.collection_class(self, name)
+            return self.collections[name]
+
+    def get_collection(self, name: str) -> LocalCollection:
+        return self[name]
+
+    def list_collection_names(self) -> list:
+        return list(self.collections)
+
+    def drop_collection(self, name: str) -> None:
+        self[name].drop()
+
+    def command(self, command, *args, **kwargs):
+        raise OperationFailure(f"{command} is not supported by the local database {self.name}")
+
+
+class MemoryDatabase(LocalDatabase):
+    """
+    A database kept in memory, lost when the process ends.
+    """
+
+    collection_class = MemoryCollection
+
+
+class SQLiteDatabase(LocalDatabase):
+    """
+    A database stored in a sqlite file.
+    """
+
+    collection_class = SQLiteCollection
+
+    def __init__(self, path: str, name: str = None) -> None:
+        super().__init__(name or os.path.splitext(os.path.basename(path))[0])
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # The stages of the pipeline share the connection from several threads, behind self.lock
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        for (table,) in self.connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"
+        ):
+            self[table]
+
+    def drop_collection(self, name: str) -> None:
+        with self.lock:
+            self.connection.execute(f"DROP TABLE IF EXISTS {self[name].table}")
+            self.connection.commit()
+            del self.collections[name]
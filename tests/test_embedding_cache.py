@@ -0,0 +1,40 @@
+import numpy as np
+import embedding_cache
+
+
+class FakeEmbeddingModel:
+    """
+    Embeds a paragraph as its length repeated over a few dimensions.
+    """
+
+    dimension = 3
+
+    def __init__(self):
+        self.encoded = []
+
+    def encode(self, paragraphs, **kwargs):
+        self.encoded.extend(paragraphs)
+        return np.array(
+            [[len(paragraph)] * self.dimension for paragraph in paragraphs], dtype=np.float32
+        )
+
+
+def test_get_embeddings_after_an_empty_call(tmp_path, monkeypatch):
+    monkeypatch.setattr(embedding_cache, "_indexes", {})
+    model = FakeEmbeddingModel()
+    empty = embedding_cache.get_embeddings([], model, "fake", cache_folder=str(tmp_path))
+    assert empty.shape == (0, 0)
+
+    paragraphs = ["高血压是一种常见病", "糖尿病", "高血压是一种常见病"]
+    embeddings = embedding_cache.get_embeddings(
+        paragraphs, model, "fake", cache_folder=str(tmp_path)
+    )
+    assert embeddings.shape == (3, FakeEmbeddingModel.dimension)
+    assert embeddings[:, 0].tolist() == [9, 3, 9]
+    assert model.encoded == ["高血压是一种常见病", "糖尿病"]
+
+    again = embedding_cache.get_embeddings(
+        paragraphs[:2], model, "fake", cache_folder=str(tmp_path)
+    )
+    assert again[:, 0].tolist() == [9, 3]
+    assert len(model.encoded) == 2
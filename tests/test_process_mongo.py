@@ -0,0 +1,34 @@
+import storage
+from process_mongo import merge
+
+
+def test_merge_chunked_skips_the_documents_without_the_join_field():
+    database = storage.get_database("memory://", "test_merge_chunked")
+    database["demands"].insert_many(
+        [
+            {"title": "a", "read": 1},
+            {"title": "b", "read": 2},
+            {"read": 3},
+            {"title": None, "read": 4},
+        ]
+    )
+    database["indexs_zh"].insert_many(
+        [
+            {"title": "a", "fog": 0.5},
+            {"title": "c", "fog": 0.7},
+            {"fog": 0.8},
+            {"fog": 0.9},
+        ]
+    )
+    merge(
+        database,
+        "demands",
+        "indexs_zh",
+        "title",
+        "title",
+        "merge",
+        method="chunked",
+        chunk_size=2,
+    )
+    merged = list(database["merge"].find({}, {"_id": 0}))
+    assert merged == [{"title": "a", "fog": 0.5, "read": 1}]
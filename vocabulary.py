@@ -0,0 +1,140 @@
+'''
+it is a file that contains the vocabularies mapping the tokens and the part-of-speech tags to integer ids.
+Notes:
+1. the segment stage stores an article as packed arrays of ids ('token_ids', 'pos_ids', see process_mongo.pack_array) instead of lists of strings, a token id takes 4 bytes whatever the length of the word. The two arrays come from two cuts of the text and are not aligned, see segmentation.py.
+2. the vocabularies are kept in the vocabulary collection (global_var.vocabulary_collection_name), one document per token: {"_id": "<kind>:<id>", "kind": ..., "id": ..., "token": ...}. The id 0 is kept for the unknown tokens.
+3. the ids are given by the process which segments the articles, only one segment stage may run at a time. The new tokens are inserted before the articles using them are written, so an interrupted run leaves no article with an unknown id.
+4. the word lists of the indexs and the sentiment dictionary are mapped to ids once per stage, then the indexs are counted on the integer arrays with NumPy.
+'''
+
+
+import numpy as np
+from pymongo import InsertOne
+from pymongo.collection import Collection
+import global_var
+import instrumentation
+
+WORD = "word"
+POS = "pos"
+
+
+class Vocabulary:
+    """
+    The ids of the tokens of one kind, loaded from and saved to the vocabulary collection.
+
+    Example:
+        >>> words = Vocabulary(database[global_var.vocabulary_collection_name], WORD)
+        >>> token_ids = words.encode(["高血压", "是", "一种"])
+        >>> words.flush()
+    """
+
+    def __init__(self, collection: Collection, kind: str = WORD) -> None:
+        """
+        Args:
+            collection (Collection): The vocabulary collection.
+            kind (str, optional): The kind of the tokens, WORD or POS.
+        """
+        self.collection = collection
+        self.kind = kind
+        self.ids = {}
+        self.tokens = [None]
+        self.pending = []
+        records = collection.find({"kind": kind}, {"_id": 0, "id": 1, "token": 1})
+        for record in instrumentation.timed_iter(records, f"mongo.read.{collection.name}"):
+            if record["id"] >= len(self.tokens):
+                self.tokens.extend([None] * (record["id"] + 1 - len(self.tokens)))
+            self.tokens[record["id"]] = record["token"]
+            self.ids[record["token"]] = record["id"]
+
+    def __len__(self) -> int:
+        """
+        Returns the number of ids, including the id 0 of the unknown tokens.
+        """
+        return len(self.tokens)
+
+    def encode(self, tokens: list, dtype=np.uint32) -> np.ndarray:
+        """
+        Maps tokens to their ids, the unknown tokens are given new ids.
+
+        Args:
+            tokens (list): The tokens.
+            dtype (optional): The dtype of the ids.
+
+        Returns:
+            np.ndarray: The id of each token.
+        """
+        token_ids = np.empty(len(tokens), dtype=dtype)
+        for index, token in enumerate(tokens):
+            token_id = self.ids.get(token)
+            if token_id is None:
+                token_id = len(self.tokens)
+                self.ids[token] = token_id
+                self.tokens.append(token)
+                self.pending.append(token_id)
+            token_ids[index] = token_id
+        return token_ids
+
+    def lookup(self, tokens) -> np.ndarray:
+        """
+        Maps tokens to their ids without adding the unknown tokens, which are mapped to 0.
+        """
+        return np.array([self.ids.get(token, 0) for token in tokens], dtype=np.uint32)
+
+    def decode(self, token_ids) -> list:
+        """
+        Maps ids back to their tokens.
+        """
+        return [self.tokens[token_id] for token_id in token_ids]
+
+    def token_lengths(self) -> np.ndarray:
+        """
+        Returns the number of characters of the token of each id, 0 for the unknown id.
+        """
+        return np.array([len(token or "") for token in self.tokens], dtype=np.uint32)
+
+    def flush(self) -> int:
+        """
+        Inserts the tokens given an id since the last flush.
+
+        Returns:
+            int: The number of inserted tokens.
+        """
+        if not self.pending:
+            return 0
+        requests = [
+            InsertOne(
+                {
+                    "_id": f"{self.kind}:{token_id}",
+                    "kind": self.kind,
+                    "id": token_id,
+                    "token": self.tokens[token_id],
+                }
+            )
+            for token_id in self.pending
+        ]
+        with instrumentation.timed(f"mongo.write.{self.collection.name}"):
+            # A duplicate _id means another process gave the same ids, which must not go unnoticed
+            self.collection.bulk_write(requests, ordered=False)
+        inserted = len(self.pending)
+        self.pending = []
+        return inserted
+
+
+def load_vocabularies(collection: Collection) -> dict:
+    """
+    Loads the word and the part-of-speech vocabularies.
+
+    Args:
+        collection (Collection): The vocabulary collection.
+
+    Returns:
+        dict: A dictionary mapping WORD and POS to their Vocabulary.
+    """
+    return {kind: Vocabulary(collection, kind) for kind in (WORD, POS)}
+
+
+def get_vocabulary_collection(collection: Collection) -> Collection:
+    """
+    Returns the vocabulary collection of the database holding a collection.
+    """
+    return collection.database[global_var.vocabulary_collection_name]